@@ -1,38 +1,357 @@
 import sublime
 import sublime_plugin
-import subprocess as sub
 import os
 import sys
+import threading
+from concurrent import futures
+from . import core
 from . import difflib
+from . import dirty
+from . import project
+from . import schedule
+from . import stats
+from .core import CACHE, DAEMONS, STATS, ErrMsg
 
 PLUGIN_NAME = 'Fmt'
 SETTINGS_KEY = PLUGIN_NAME + '.sublime-settings'
-IS_WINDOWS = os.name == 'nt'
 PANEL_OUTPUT_NAME = 'output.' + PLUGIN_NAME
+MAX_WORKERS = os.cpu_count() or 4
+
+# Invocation plans by view id, then by scope. See `core.Plan`.
+PLANS = {}
+
+# Line tables by view id, reused by line-level diffs of the same view. Only
+# used on the main thread. See `difflib.LineTable`.
+LINE_TABLES = {}
+
+# Lines changed since the last format, by buffer id. Missing until a buffer is
+# first formatted, meaning that any line may have changed. Only used on the
+# main thread. See `dirty.DirtyLines`.
+DIRTY_LINES = {}
+
+# Results of async formatting, by view id, waiting to be applied on the main
+# thread by `fmt_apply_async`.
+ASYNC_RESULTS = {}
+
+# Results of formatting the whole buffer ahead of a save, by view id:
+# `(change_count, rows, source, fmted)`. Written and read on the main thread.
+# See "preformat_idle_ms".
+STAGED = {}
+
+# Background formats by view id; see `schedule`.
+SCHEDULER = schedule.Scheduler()
+
+# Ids of windows running "Fmt: Format Project".
+PROJECT_RUNS = set()
+
+# Ids of views being re-saved after async formatting. Their next save must not
+# trigger another format.
+ASYNC_SAVING = set()
+
+def plugin_loaded():
+    sublime.load_settings(SETTINGS_KEY).add_on_change(PLUGIN_NAME, SETTINGS_INDEX.clear)
+
+def plugin_unloaded():
+    sublime.load_settings(SETTINGS_KEY).clear_on_change(PLUGIN_NAME)
+    DAEMONS.stop_all()
 
 class fmt_listener(sublime_plugin.EventListener):
     def on_pre_save(self, view):
-        if is_enabled(view) and get_setting(view, 'format_on_save'):
-            view.run_command('fmt_format_buffer')
+        if view.id() in ASYNC_SAVING:
+            ASYNC_SAVING.discard(view.id())
+            return
+
+        try:
+            if not is_enabled(view) or not get_setting(view, 'format_on_save'):
+                return
+            is_async = get_setting(view, 'format_on_save_async')
+            dirty_only = save_range(view) == 'dirty'
+        except ErrMsg as err:
+            report(view, err)
+            return
 
+        if is_async:
+            fmt_buffer_async(view, dirty_only)
+            return
+
+        view.run_command('fmt_format_buffer', {'dirty_only': dirty_only})
+
+    def on_modified(self, view):
+        try:
+            delay = preformat_delay(view)
+        except ErrMsg:
+            return
+        if delay:
+            schedule_preformat(view, delay)
+
+    def on_close(self, view):
+        SETTINGS_INDEX.close_view(view.id())
+        PLANS.pop(view.id(), None)
+        STAGED.pop(view.id(), None)
+        ASYNC_RESULTS.pop(view.id(), None)
+        ASYNC_SAVING.discard(view.id())
+        SCHEDULER.cancel(view.id())
+        # Clones of the view, if any, start over with the whole buffer.
+        DIRTY_LINES.pop(view.buffer_id(), None)
+        LINE_TABLES.pop(view.id(), None)
+
+class fmt_dirty_listener(sublime_plugin.TextChangeListener):
+    @classmethod
+    def is_applicable(cls, buffer):
+        return True
+
+    def on_text_changed(self, changes):
+        lines = DIRTY_LINES.get(self.buffer.id())
+        if lines is None:
+            return
+        # Changes made by formatting are reported after the tracker was
+        # replaced, and are already formatted.
+        view = self.buffer.primary_view()
+        if view is None or view.change_count() <= lines.change_count:
+            return
+        for change in changes:
+            lines.change(change.a.row, change.b.row, change.str)
+
+# With `dirty_only`, formats only the lines changed since the last format, if
+# any, as far as the formatter supports it. See "format_on_save_range".
 class fmt_format_buffer(sublime_plugin.TextCommand):
-    def run(self, edit):
+    def run(self, edit, dirty_only=False):
         view = self.view
         try:
-            fmt_region(view, edit, view_region(view))
+            rows = dirty_rows(view) if dirty_only else None
+            if rows is False:
+                return
+            fmt_region(view, edit, view_region(view), rows)
+            mark_formatted(view)
         except Exception as err:
             report(view, err)
 
 class fmt_format_selection(sublime_plugin.TextCommand):
     def run(self, edit):
         view = self.view
+        regions = [region for region in view.sel() if not region.empty()]
+        if not regions:
+            return
+
+        hide_panel(view.window())
+        # Background formats of the buffer as it is now would be stale.
+        SCHEDULER.cancel(view.id())
+        encoding = view_encoding(view)
+        jobs = [
+            (region, view.substr(region), view.scope_name(region.begin()), stats.Timing())
+            for region in regions
+        ]
+
+        def run_job(job):
+            (_, source, scope, timing) = job
+            return fmt(view, source, encoding, scope, timing)
+
+        results = run_parallel(run_job, jobs)
+        errs = []
+
+        # Bottom-up, so that edits don't shift the regions not yet applied.
+        for ((region, source, scope, timing), (fmted, err)) in reversed(list(zip(jobs, results))):
+            if err is None:
+                try:
+                    merge_fmted(view, edit, region, source, fmted, scope, timing)
+                except Exception as merge_err:
+                    err = merge_err
+            record_timing(view, scope, timing)
+            if err is not None:
+                errs.append(err)
+
+        if len(errs) == 1:
+            report(view, errs[0])
+        elif errs:
+            report(view, '\n\n'.join(str(err) for err in reversed(errs)))
+
+class fmt_apply_async(sublime_plugin.TextCommand):
+    def run(self, edit):
+        view = self.view
+        result = ASYNC_RESULTS.pop(view.id(), None)
+        if result is None:
+            return
 
-        for region in view.sel():
+        (change_count, source, fmted, scope, timing) = result
+
+        # The buffer was edited while the formatter was running; the result is
+        # stale. The file stays unformatted on disk until the next save, which
+        # also covers the edit.
+        if view.change_count() != change_count:
+            timing.event('stale_result')
+            record_timing(view, scope, timing)
+            return
+
+        try:
+            merge_fmted(view, edit, view_region(view), source, fmted, scope, timing)
+        except Exception as err:
+            report(view, err)
+            return
+        finally:
+            record_timing(view, scope, timing)
+
+        mark_formatted(view)
+        if view.change_count() != change_count:
+            ASYNC_SAVING.add(view.id())
+            sublime.set_timeout(lambda: resave(view), 0)
+
+# Formats the files under the window's folders on disk, in parallel, with the
+# rules that would apply to them in views. Changed files are written back
+# atomically. Files with unsaved changes in a view are left alone.
+class fmt_format_project(sublime_plugin.WindowCommand):
+    def run(self):
+        window = self.window
+        if window.id() in PROJECT_RUNS:
+            return
+
+        folders = window.folders()
+        if not folders:
+            show_panel_text(window, '[{}] no folders to format'.format(PLUGIN_NAME))
+            return
+
+        msg = 'Format every file with a matching rule in {} folder{} and overwrite the changed ones on disk?'.format(
+            len(folders),
+            '' if len(folders) == 1 else 's',
+        )
+        if not sublime.ok_cancel_dialog(msg, 'Format'):
+            return
+
+        PROJECT_RUNS.add(window.id())
+        settings = FileSettings(window)
+        progress = project.Progress(folders[0] if len(folders) == 1 else None)
+        dirty_files = {
+            os.path.realpath(view.file_name())
+            for other in sublime.windows() for view in other.views()
+            if view.file_name() and view.is_dirty()
+        }
+        paths = project.walk(
+            folders,
+            settings.get('folder_exclude_patterns') or (),
+            list(settings.get('file_exclude_patterns') or ()) + list(settings.get('binary_file_patterns') or ()),
+        )
+        lock = threading.Lock()
+        show_panel_text(window, progress.render())
+
+        def show_progress():
+            ensure_panel(window).run_command('fmt_panel_replace_content', {'text': progress.render()})
+
+        # Each worker runs one formatter at a time, pulling paths as it goes.
+        def work():
+            while True:
+                with lock:
+                    path = next(paths, None)
+                if path is None:
+                    return
+                if os.path.realpath(path) in dirty_files:
+                    (outcome, err) = (project.SKIPPED, None)
+                else:
+                    try:
+                        (outcome, err) = (fmt_file(window, settings, path), None)
+                    except Exception as file_err:
+                        (outcome, err) = (project.FAILED, file_err)
+                if progress.add(path, outcome, err):
+                    sublime.set_timeout(show_progress, 0)
+
+        def run():
+            try:
+                with futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+                    for _ in range(MAX_WORKERS):
+                        pool.submit(work)
+            finally:
+                PLANS.pop(file_view_id(window), None)
+                SETTINGS_INDEX.close_view(file_view_id(window))
+                sublime.set_timeout(finish, 0)
+
+        def finish():
+            PROJECT_RUNS.discard(window.id())
+            show_panel_text(window, '[{}] {}'.format(PLUGIN_NAME, progress.render(done=True)))
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+
+# Formats a file on disk with `project.fmt_file`, skipping files with no
+# syntax or no rule with "cmd" without reading more than their first line.
+def fmt_file(window, settings, path):
+    def fmt_for(first_line):
+        syntax = sublime.find_syntax_for_file(path, first_line)
+        if syntax is None:
+            return None
+
+        view = FileView(window, settings, path, syntax.scope)
+        if not get_setting(view, 'cmd', syntax.scope):
+            return None
+
+        def fmt_source(source):
+            timing = stats.Timing()
             try:
-                fmt_region(view, edit, region)
-            except Exception as err:
-                report(view, err)
-                break
+                return fmt(view, source, 'UTF-8', syntax.scope, timing)
+            finally:
+                record_timing(view, syntax.scope, timing)
+
+        return fmt_source
+
+    return project.fmt_file(path, fmt_for)
+
+# Stands in for a view of a file that isn't open, supporting the part of the
+# View API that `fmt` and settings lookup use. All files of a window share an
+# id, so that settings are resolved once per scope; window ids are negated to
+# stay apart from view ids.
+class FileView(object):
+    def __init__(self, window, settings, path, scope):
+        self.win = window
+        self.view_settings = settings
+        self.path = path
+        self.scope = scope
+
+    def id(self):
+        return file_view_id(self.win)
+
+    def window(self):
+        return self.win
+
+    def settings(self):
+        return self.view_settings
+
+    def file_name(self):
+        return self.path
+
+    def scope_name(self, point):
+        return self.scope + ' '
+
+def file_view_id(window):
+    return -window.id()
+
+# Settings of `FileView`s. Files that aren't open have no view settings, so
+# these come from the project's settings, falling back on the user's
+# preferences.
+class FileSettings(object):
+    KEYS = (PLUGIN_NAME, 'tab_size', 'translate_tabs_to_spaces', 'folder_exclude_patterns', 'file_exclude_patterns', 'binary_file_patterns')
+
+    def __init__(self, window):
+        preferences = sublime.load_settings('Preferences.sublime-settings')
+        overrides = (window.project_data() or {}).get('settings') or {}
+        self.vals = {key: overrides.get(key, preferences.get(key)) for key in self.KEYS}
+
+    def get(self, key, default=None):
+        val = self.vals.get(key)
+        return default if val is None else val
+
+    def add_on_change(self, key, fun):
+        pass
+
+    def clear_on_change(self, key):
+        pass
+
+class fmt_show_stats(sublime_plugin.WindowCommand):
+    def run(self):
+        window = self.window
+        text = '[{}] performance stats\n\n{}\n\ncache: {}'.format(
+            PLUGIN_NAME,
+            STATS.render(),
+            ', '.join('{}={}'.format(key, val) for (key, val) in sorted(CACHE.stats().items())),
+        )
+        show_panel_text(window, text)
 
 class fmt_panel_replace_content(sublime_plugin.TextCommand):
     def run(self, edit, text):
@@ -40,112 +359,320 @@ class fmt_panel_replace_content(sublime_plugin.TextCommand):
         view.replace(edit, view_region(view), text)
         view.sel().clear()
 
-# TODO: any other exception type should be printed with the stack. Only error
-# messages generated by Fmt, as `ErrMsg`, should have the stack suppressed
-# (which is the default behavior of `str.format`).
-class ErrMsg(Exception):
-    pass
-
-def fmt_region(view, edit, region):
+# `rows` are the rows of the region that need formatting, if not all of them.
+def fmt_region(view, edit, region, rows=None):
     if region.empty():
         return
 
     hide_panel(view.window())
 
-    source = view.substr(region)
+    SCHEDULER.cancel(view.id())
+
+    timing = stats.Timing()
     scope = view.scope_name(region.begin())
-    fmted = fmt(view, source, view_encoding(view), scope)
+    staged = take_staged(view, region, rows)
+    try:
+        if staged is not None:
+            timing.event('staged_result')
+            (source, fmted) = staged
+        else:
+            source = view.substr(region)
+            fmted = fmt(view, source, view_encoding(view), scope, timing, rows)
+        merge_fmted(view, edit, region, source, fmted, scope, timing)
+    finally:
+        record_timing(view, scope, timing)
+
+def merge_fmted(view, edit, region, source, fmted, scope, timing):
     if fmted == source:
         return
 
-    merge_type = get_setting(view, 'merge_type', scope)
+    with timing.phase('settings'):
+        merge_type = get_setting(view, 'merge_type', scope)
+        diff_timeout_ms = get_setting(view, 'diff_timeout_ms', scope)
+        diff_engine = get_setting(view, 'diff_engine', scope) or 'myers'
+
+    if merge_type == 'diff' and diff_engine != 'myers':
+        merge_engine_into_view(view, edit, source, fmted, region, timing, diff_engine, diff_timeout_ms)
+        return
 
     if merge_type == 'diff':
         try:
-            merge_into_view(view, edit, fmted, region)
+            merge_into_view(view, edit, source, fmted, region, timing, diff_timeout_ms)
         except difflib.TooManyDiffsException:
-            replace_view(view, edit, fmted, region)
+            timing.event('too_many_diffs_fallback')
+            with timing.phase('apply'):
+                replace_view(view, edit, fmted, region)
+        return
+
+    if merge_type == 'line_diff':
+        merge_engine_into_view(view, edit, source, fmted, region, timing, 'patience', diff_timeout_ms)
         return
 
     if merge_type == 'replace':
-        replace_view(view, edit, fmted, region)
+        with timing.phase('apply'):
+            replace_view(view, edit, fmted, region)
         return
 
     report(view, 'unknown value of setting "merge_type": {}'.format(merge_type))
 
-def fmt(view, input, encoding, scope):
-    cmd = get_setting(view, 'cmd', scope)
+# Formats the entire buffer on a background thread. The result is applied on
+# the main thread only if the buffer hasn't changed in the meantime, after
+# which the view is saved again. For `dirty_only`, see `fmt_format_buffer`.
+def fmt_buffer_async(view, dirty_only=False):
+    rows = dirty_rows(view) if dirty_only else None
+    if rows is False:
+        return
 
-    if not cmd:
-        raise ErrMsg('unable to find setting "cmd" for scope "{}"'.format(scope))
+    hide_panel(view.window())
 
-    if not isinstance(cmd, list) or not every(cmd, is_string):
-        raise ErrMsg('expected setting "cmd" to be a list of strings, found {}'.format(cmd))
+    change_count = view.change_count()
+    scope = view.scope_name(0)
+    staged = take_staged(view, view_region(view), rows)
+    if staged is not None:
+        timing = stats.Timing()
+        timing.event('staged_result')
+        (source, fmted) = staged
+        if fmted == source:
+            record_timing(view, scope, timing)
+            mark_formatted(view)
+        else:
+            ASYNC_RESULTS[view.id()] = (change_count, source, fmted, scope, timing)
+            sublime.set_timeout(lambda: apply_async(view), 0)
+        return
 
-    # Support "$variable" substitutions.
-    variables = extract_variables(view)
-    cmd = [sublime.expand_variables(arg, variables) for arg in cmd]
+    source = view.substr(view_region(view))
+    encoding = view_encoding(view)
 
-    proc = sub.Popen(
-        args=cmd,
-        stdin=sub.PIPE,
-        stdout=sub.PIPE,
-        stderr=sub.PIPE,
-        startupinfo=process_startup_info(),
-        universal_newlines=False,
-        cwd=guess_cwd(view),
-        env=get_env(view, scope),
-    )
+    def run(job):
+        timing = stats.Timing()
+        try:
+            fmted = job.once(lambda: fmt(view, source, encoding, scope, timing, rows, job))
+            if job.reused:
+                timing.event('reused_result')
+        except schedule.Cancelled:
+            timing.event('cancelled')
+            record_timing(view, scope, timing)
+            return
+        except Exception as err:
+            record_timing(view, scope, timing)
+            # `err` is unbound once the `except` block ends.
+            sublime.set_timeout(lambda err=err: report(view, err), 0)
+            return
+
+        if fmted == source:
+            record_timing(view, scope, timing)
+            sublime.set_timeout(lambda: mark_formatted(view, change_count), 0)
+            return
+
+        ASYNC_RESULTS[view.id()] = (change_count, source, fmted, scope, timing)
+        sublime.set_timeout(lambda: apply_async(view), 0)
+
+    SCHEDULER.submit(view.id(), (change_count, rows), run)
+
+def preformat_delay(view):
+    if not is_enabled(view) or not get_setting(view, 'format_on_save'):
+        return None
+    return get_setting(view, 'preformat_idle_ms')
 
-    timeout = get_setting(view, 'timeout', scope)
+def schedule_preformat(view, delay):
+    change_count = view.change_count()
+    sublime.set_timeout(lambda: preformat_if_idle(view, change_count), delay)
+
+# Formats the whole buffer in the background if it hasn't changed since
+# `change_count`, and stages the result for the next save, which applies it
+# instead of invoking the formatter. Errors are left for that save to report.
+def preformat_if_idle(view, change_count):
+    if not view.is_valid() or view.change_count() != change_count or not view.is_dirty():
+        return
+    staged = STAGED.get(view.id())
+    if staged is not None and staged[0] == change_count:
+        return
 
     try:
-        (stdout, stderr) = proc.communicate(input=bytes(input, encoding=encoding), timeout=timeout)
-    finally:
+        delay = preformat_delay(view)
+        rows = dirty_rows(view) if delay and save_range(view) == 'dirty' else None
+        if rows is False:
+            return
+    except ErrMsg:
+        return
+    if not delay:
+        return
+
+    source = view.substr(view_region(view))
+    scope = view.scope_name(0)
+    encoding = view_encoding(view)
+
+    def run(job):
+        timing = stats.Timing()
+        timing.event('preformat')
         try:
-            proc.kill()
-        except:
-            pass
-
-    stdout = stdout.decode(encoding)
-    stderr = stderr.decode(encoding)
-
-    if proc.returncode != 0:
-        msg = str(sub.CalledProcessError(proc.returncode, cmd))
-        if len(stderr) > 0:
-            msg += ':\n' + stderr
-        elif len(stdout) > 0:
-            msg += ':\n' + stdout
-        raise ErrMsg(msg)
-
-    if len(stdout) == 0 and len(stderr) > 0:
-        raise ErrMsg(stderr)
-
-    return stdout
-
-def merge_into_view(view, edit, content, region):
-    def subview(start, end):
-        return view.substr(sublime.Region(start, end))
-
-    diffs = difflib.myers_diffs(subview(0, view.size()), content)
-    difflib.cleanup_efficiency(diffs)
-    offset = region.begin()
-
-    for (op_type, patch) in diffs:
-        patch_len = len(patch)
-        if op_type == difflib.Ops.EQUAL:
-            if subview(offset, offset+patch_len) != patch:
-                report(view, "mismatch between diff's source and current content")
-                return
-            offset += patch_len
-        elif op_type == difflib.Ops.INSERT:
-            view.insert(edit, offset, patch)
-            offset += patch_len
-        elif op_type == difflib.Ops.DELETE:
-            if subview(offset, offset+patch_len) != patch:
-                report(view, "mismatch between diff's source and current content")
-                return
-            view.erase(edit, sublime.Region(offset, offset+patch_len))
+            fmted = job.once(lambda: fmt(view, source, encoding, scope, timing, rows, job))
+            if job.reused:
+                timing.event('reused_result')
+        except schedule.Cancelled:
+            timing.event('cancelled')
+            fmted = None
+        except Exception:
+            fmted = None
+        record_timing(view, scope, timing)
+        if fmted is not None:
+            sublime.set_timeout(lambda: stage(fmted), 0)
+
+    def stage(fmted):
+        if view.is_valid() and view.change_count() == change_count:
+            STAGED[view.id()] = (change_count, rows, source, fmted)
+
+    SCHEDULER.submit(view.id(), (change_count, rows), run)
+
+# Returns `(source, fmted)` staged by `preformat_if_idle` for the current
+# content of the region, which must be the whole buffer, and `rows`, if any.
+def take_staged(view, region, rows):
+    staged = STAGED.pop(view.id(), None)
+    if staged is None:
+        return None
+    (change_count, staged_rows, source, fmted) = staged
+    if view.change_count() != change_count or staged_rows != rows:
+        return None
+    if region.begin() != 0 or region.end() != view.size():
+        return None
+    return (source, fmted)
+
+# Calls `fun` for each value on a bounded thread pool. Returns a list of
+# `(result, exception)` in the original order.
+def run_parallel(fun, vals):
+    def run(val):
+        try:
+            return (fun(val), None)
+        except Exception as err:
+            return (None, err)
+
+    if len(vals) == 1:
+        return [run(vals[0])]
+
+    with futures.ThreadPoolExecutor(max_workers=min(len(vals), MAX_WORKERS)) as pool:
+        return list(pool.map(run, vals))
+
+# Results stored after the view was closed would never be applied or freed.
+def apply_async(view):
+    if view.is_valid():
+        view.run_command('fmt_apply_async')
+    else:
+        ASYNC_RESULTS.pop(view.id(), None)
+
+def resave(view):
+    if view.is_valid():
+        view.run_command('save')
+    else:
+        ASYNC_SAVING.discard(view.id())
+
+# Starts tracking changed lines anew, now that the buffer is formatted. With
+# `change_count`, only if the buffer hasn't changed since.
+def mark_formatted(view, change_count=None):
+    if not view.is_valid():
+        return
+    if change_count is not None and view.change_count() != change_count:
+        return
+    DIRTY_LINES[view.buffer_id()] = dirty.DirtyLines(view.change_count())
+
+# Rows changed since the last format, as from `DirtyLines.bounds`, for
+# "format_on_save_range": "dirty". None when the changes weren't tracked, to
+# format the whole buffer, and False when nothing changed.
+def dirty_rows(view):
+    lines = DIRTY_LINES.get(view.buffer_id())
+    if lines is None:
+        return None
+    rows = lines.bounds()
+    if rows is not None:
+        return rows
+    if view.change_count() > lines.change_count:
+        return None
+    return False
+
+def save_range(view):
+    val = get_setting(view, 'format_on_save_range') or 'buffer'
+    if val not in ('buffer', 'dirty'):
+        raise ErrMsg('unknown value of setting "format_on_save_range": {}'.format(val))
+    return val
+
+# `rows` are passed to the formatter via "$dirty_*" variables; see
+# `core.fmt`.
+def fmt(view, input, encoding, scope, timing=None, rows=None, job=None):
+    if timing is None:
+        timing = stats.Timing()
+
+    with timing.phase('settings'):
+        plan = invocation_plan(view, scope)
+        settings = SETTINGS_INDEX.resolve(view, scope)
+
+    return core.fmt(plan, settings, input, encoding, timing, rows, job)
+
+# Reuses the `core.Plan` of the view and scope, if nothing it depends on has
+# changed.
+def invocation_plan(view, scope):
+    window = view.window()
+    settings = view.settings()
+
+    # The resolved settings are replaced whenever the rules change.
+    key = (
+        SETTINGS_INDEX.resolve(view, scope),
+        view.file_name(),
+        window.project_file_name(),
+        tuple(window.folders()),
+        settings.get('tab_size'),
+        settings.get('translate_tabs_to_spaces'),
+    )
+
+    plans = PLANS.setdefault(view.id(), {})
+    entry = plans.get(scope)
+    if entry is not None and entry[0] == key:
+        return entry[1]
+
+    plan = core.Plan(
+        SETTINGS_INDEX.resolve(view, scope),
+        scope,
+        lambda: extract_variables(view),
+        guess_cwd(view),
+        view.file_name(),
+        sublime.expand_variables,
+    )
+    plans[scope] = (key, plan)
+    return plan
+
+# Diffs `source`, which must be the current content of `region`, against
+# `content`, and applies the result to the region. See `core.merge_diff`.
+def merge_into_view(view, edit, source, content, region, timing, timeout_ms=None):
+    core.merge_diff(ViewBuffer(view, edit), source, content, region.begin(), timing, timeout_ms, line_table(view))
+
+# Like `merge_into_view`, but uses the given engine from `difflib.ENGINES`.
+# See `core.merge_engine`.
+def merge_engine_into_view(view, edit, source, content, region, timing, engine, timeout_ms=None):
+    core.merge_engine(ViewBuffer(view, edit), source, content, region.begin(), timing, engine, timeout_ms, line_table(view))
+
+# The buffer of a view, as `core` expects it, for the duration of `edit`.
+class ViewBuffer(object):
+    def __init__(self, view, edit):
+        self.view = view
+        self.edit = edit
+
+    def size(self):
+        return self.view.size()
+
+    def replace(self, start, end, text):
+        self.view.replace(self.edit, sublime.Region(start, end), text)
+
+def line_table(view):
+    table = LINE_TABLES.get(view.id())
+    if table is None:
+        table = LINE_TABLES[view.id()] = difflib.LineTable()
+    return table
+
+def record_timing(view, scope, timing):
+    try:
+        rule = get_setting(view, 'selector', scope)
+    except ErrMsg:
+        rule = None
+    # Settings outside of rules don't have a selector.
+    STATS.record(rule or scope.split(' ')[0], timing)
 
 def replace_view(view, edit, content, region):
     position = view.viewport_position()
@@ -156,7 +683,12 @@ def replace_view(view, edit, content, region):
 
 def report(view, msg):
     window = view.window()
-    style = get_setting(view, 'error_style')
+
+    # Invalid rules make every setting lookup fail, including this one.
+    try:
+        style = get_setting(view, 'error_style')
+    except ErrMsg:
+        style = None
 
     if style == '':
         return
@@ -184,52 +716,8 @@ def report(view, msg):
 
     sublime.error_message('[{}] unknown value of setting "error_style": {}'.format(PLUGIN_NAME, style))
 
-# Copied from other plugins, haven't personally tested on Windows.
-def process_startup_info():
-    if not IS_WINDOWS:
-        return None
-    startupinfo = sub.STARTUPINFO()
-    startupinfo.dwFlags |= sub.STARTF_USESHOWWINDOW
-    startupinfo.wShowWindow = sub.SW_HIDE
-    return startupinfo
-
 def guess_cwd(view):
-    window = view.window()
-    mode = get_setting(view, 'cwd_mode') or ''
-
-    if mode.startswith(':'):
-        return mode[1:]
-
-    if mode == 'none':
-        return None
-
-    if mode == 'project_root':
-        if len(window.folders()):
-            return window.folders()[0]
-        return None
-
-    if mode == 'auto':
-        if view.file_name():
-            return os.path.dirname(view.file_name())
-        if len(window.folders()):
-            return window.folders()[0]
-
-def get_in(val, *path):
-    for key in path:
-        val, ok = get(val, key)
-        if not ok:
-            return (None, False)
-    return (val, True)
-
-def get(val, key):
-    if (
-        isinstance(val, dict) and key in val
-    ) or (
-        (isinstance(val, list) or isinstance(val, tuple)) and
-        (isinstance(key, int) and len(val) > key)
-    ):
-        return (val[key], True)
-    return (None, False)
+    return core.guess_cwd(get_setting(view, 'cwd_mode'), view.file_name(), view.window().folders())
 
 def view_scope(view):
     scopes = view.scope_name(0)
@@ -238,43 +726,73 @@ def view_scope(view):
 def get_setting(view, key, scope = None):
     if scope is None:
         scope = view_scope(view)
-
-    overrides = view.settings().get(PLUGIN_NAME)
-
-    rule = rule_for_scope(get(overrides, 'rules')[0], scope)
-    (val, found) = get(rule, key)
-    if found:
-        return val
-
-    (val, found) = get_in(overrides, key)
-    if found:
-        return val
-
-    settings = sublime.load_settings(SETTINGS_KEY)
-
-    rule = rule_for_scope(settings.get('rules'), scope)
-    (val, found) = get(rule, key)
-    if found:
-        return val
-
-    return settings.get(key)
-
-def rule_for_scope(rules, scope):
-    if not rules:
-        return None
-
-    rule = max(rules, key = lambda rule: rule_score(rule, scope))
-
-    # Note: `max` doesn't ensure this condition.
-    if rule_score(rule, scope) > 0:
-        return rule
-
-    return None
-
-def rule_score(rule, scope):
-    if 'selector' not in rule:
-        raise ErrMsg('missing "selector" in rule {}'.format(rule))
-    return sublime.score_selector(scope, rule['selector'])
+    return SETTINGS_INDEX.resolve(view, scope).get(key)
+
+# Resolved settings for each view and scope. Rule lists are compiled and
+# validated once, rule matching is done once per scope, and each setting is
+# looked up once. Entries are invalidated when the package settings or the
+# view's "Fmt" overrides change.
+class SettingsIndex(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.package = None
+        self.views = {}
+        self.watched = set()
+
+    def resolve(self, view, scope):
+        view_id = view.id()
+        with self.lock:
+            entry = self.views.get(view_id)
+        if entry is None:
+            entry = self.view_entry(view)
+        return entry.resolve(scope)
+
+    def view_entry(self, view):
+        view_id = view.id()
+        settings = view.settings()
+        overrides = settings.get(PLUGIN_NAME)
+        package = self.package_entry()
+        entry = core.ViewSettings(overrides, package, sublime.score_selector)
+
+        with self.lock:
+            if view_id not in self.watched:
+                self.watched.add(view_id)
+                settings.add_on_change(PLUGIN_NAME, lambda: self.view_changed(view_id, settings))
+            self.views[view_id] = entry
+        return entry
+
+    def package_entry(self):
+        with self.lock:
+            package = self.package
+        if package is None:
+            settings = sublime.load_settings(SETTINGS_KEY)
+            package = (settings, core.Rules(settings.get('rules'), sublime.score_selector))
+            with self.lock:
+                self.package = package
+        return package
+
+    # Called on any change of the view's settings. Most of them are unrelated.
+    def view_changed(self, view_id, settings):
+        with self.lock:
+            entry = self.views.get(view_id)
+        if entry is not None and entry.overrides != settings.get(PLUGIN_NAME):
+            self.forget_view(view_id)
+
+    def forget_view(self, view_id):
+        with self.lock:
+            self.views.pop(view_id, None)
+
+    def close_view(self, view_id):
+        with self.lock:
+            self.views.pop(view_id, None)
+            self.watched.discard(view_id)
+
+    def clear(self):
+        with self.lock:
+            self.package = None
+            self.views.clear()
+
+SETTINGS_INDEX = SettingsIndex()
 
 def is_enabled(view):
     return bool(get_setting(view, 'cmd'))
@@ -296,27 +814,22 @@ def hide_panel(window):
     if window.active_panel() == PANEL_OUTPUT_NAME:
         window.run_command('hide_panel', {'panel': PANEL_OUTPUT_NAME})
 
+def show_panel_text(window, text):
+    ensure_panel(window).run_command('fmt_panel_replace_content', {'text': text})
+    show_panel(window)
+
 def show_panel(window):
     window.run_command('show_panel', {'panel': PANEL_OUTPUT_NAME})
 
-def every(iter, fun):
-    if iter:
-        for val in iter:
-            if not fun(val):
-                return False
-    return True
-
-def is_string(val):
-    return isinstance(val, str)
-
 def extract_variables(view):
     settings = view.settings()
-    tab_size = settings.get('tab_size') or 0
-    indent = ' ' * tab_size if settings.get('translate_tabs_to_spaces') else '\t'
 
     vars = view.window().extract_variables()
-    vars['tab_size'] = str(tab_size)
-    vars['indent'] = indent
+    # The window's variables describe its active view, which may be another
+    # file, or none, as for `FileView`.
+    if view.file_name():
+        vars.update(core.file_variables(view.file_name()))
+    vars.update(core.indent_variables(settings.get('tab_size'), settings.get('translate_tabs_to_spaces')))
     vars.update(os.environ)
 
     return vars
@@ -324,13 +837,5 @@ def extract_variables(view):
 def view_region(view):
     return sublime.Region(0, view.size())
 
-def get_env(view, scope):
-    val = get_setting(view, 'env', scope)
-    if val is None:
-        return None
-    env = os.environ.copy()
-    env.update(val)
-    return env
-
 def norm_newlines(src):
     return src.replace('\r\n', '\n')
@@ -0,0 +1,159 @@
+"""
+Headless runner: formats files on disk with the same settings and rules as the
+plugin, without Sublime. For profiling the formatting path under realistic
+load, and for pre-commit hooks and CI. Run from the directory containing the
+package, here named `Fmt`:
+
+    python3 -m Fmt [--settings FILE]... [--scope SCOPE] [--check] [--jobs N] [--stats] PATH...
+
+Settings are read from the package's `Fmt.sublime-settings`, then from every
+`--settings` file, such as `Packages/User/Fmt.sublime-settings`, each
+overriding the top-level keys of the previous ones. Directories are walked,
+skipping "folder_exclude_patterns", "file_exclude_patterns" and
+"binary_file_patterns" from the settings. Files that aren't UTF-8 or have no
+matching rule are skipped.
+
+Scopes of files are guessed from their extensions with `SCOPES`, unless given
+with `--scope`, and matched against rule selectors with
+`core.score_selector`, which approximates Sublime's scoring.
+
+Changed files are written back, unless `--check` is given, in which case they
+are only listed. Exits with 1 if any file failed, or with `--check`, would
+change. `--stats` prints the timings of `Fmt: Show Performance Stats`.
+"""
+
+import argparse
+import os
+import sys
+from concurrent import futures
+from . import core
+from . import project
+from . import stats
+
+SETTINGS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Fmt.sublime-settings')
+
+# Sublime's defaults.
+FOLDER_EXCLUDE_PATTERNS = ['.svn', '.git', '.hg', 'CVS', '.Trash', '.Trash-*']
+BINARY_FILE_PATTERNS = ['*.jpg', '*.jpeg', '*.png', '*.gif', '*.ttf', '*.tga', '*.dds', '*.ico', '*.eot', '*.pdf', '*.swf', '*.jar', '*.zip']
+
+# Base scopes of Sublime's syntaxes by file extension, for files formatted
+# without `--scope`.
+SCOPES = {
+    '.c': 'source.c',
+    '.h': 'source.c',
+    '.cc': 'source.c++',
+    '.cpp': 'source.c++',
+    '.hpp': 'source.c++',
+    '.cs': 'source.cs',
+    '.css': 'source.css',
+    '.go': 'source.go',
+    '.html': 'text.html.basic',
+    '.java': 'source.java',
+    '.js': 'source.js',
+    '.mjs': 'source.js',
+    '.jsx': 'source.jsx',
+    '.json': 'source.json',
+    '.lua': 'source.lua',
+    '.md': 'text.html.markdown',
+    '.php': 'embedding.php',
+    '.py': 'source.python',
+    '.rb': 'source.ruby',
+    '.rs': 'source.rust',
+    '.scss': 'source.scss',
+    '.sh': 'source.shell.bash',
+    '.sql': 'source.sql',
+    '.swift': 'source.swift',
+    '.ts': 'source.ts',
+    '.tsx': 'source.tsx',
+    '.yaml': 'source.yaml',
+    '.yml': 'source.yaml',
+    '.zig': 'source.zig',
+}
+
+def main():
+    parser = argparse.ArgumentParser(prog='python3 -m Fmt')
+    parser.add_argument('paths', nargs='+', metavar='PATH')
+    parser.add_argument('--settings', action='append', default=[], metavar='FILE')
+    parser.add_argument('--scope')
+    parser.add_argument('--check', action='store_true')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 4)
+    parser.add_argument('--stats', action='store_true')
+    args = parser.parse_args()
+
+    settings = {}
+    for path in [SETTINGS_PATH] + args.settings:
+        settings.update(core.load_settings(path))
+    entry = core.ViewSettings(None, (settings, core.Rules(settings.get('rules'), core.score_selector)), core.score_selector)
+
+    paths = []
+    for path in args.paths:
+        if os.path.isdir(path):
+            paths.extend(project.walk(
+                [path],
+                settings.get('folder_exclude_patterns', FOLDER_EXCLUDE_PATTERNS),
+                list(settings.get('file_exclude_patterns') or ()) + list(settings.get('binary_file_patterns', BINARY_FILE_PATTERNS)),
+            ))
+        else:
+            paths.append(path)
+
+    progress = project.Progress(os.getcwd())
+
+    def run(path):
+        try:
+            outcome = fmt_file(entry, settings, path, args.scope, args.check)
+            progress.add(path, outcome)
+        except Exception as err:
+            progress.add(path, project.FAILED, err)
+
+    try:
+        with futures.ThreadPoolExecutor(max_workers=max(args.jobs, 1)) as pool:
+            list(pool.map(run, paths))
+    finally:
+        core.DAEMONS.stop_all()
+
+    print(progress.render(done=True), file=sys.stderr)
+    if args.stats:
+        print(core.STATS.render())
+
+    if progress.counts[project.FAILED] or (args.check and progress.counts[project.CHANGED]):
+        sys.exit(1)
+
+# Like `Fmt.fmt_file`, with `SCOPES` instead of Sublime's syntaxes.
+def fmt_file(entry, settings, path, scope, check):
+    scope = scope or SCOPES.get(os.path.splitext(path)[1].lower())
+    if scope is None:
+        return project.SKIPPED
+
+    resolved = entry.resolve(scope)
+    if not resolved.get('cmd'):
+        return project.SKIPPED
+
+    path = os.path.abspath(path)
+    plan = core.Plan(
+        resolved,
+        scope,
+        lambda: file_variables(settings, path),
+        core.guess_cwd(resolved.get('cwd_mode'), path, [os.getcwd()]),
+        path,
+        core.expand_variables,
+    )
+
+    def fmt_source(source):
+        timing = stats.Timing()
+        try:
+            return core.fmt(plan, resolved, source, 'UTF-8', timing)
+        finally:
+            core.STATS.record(resolved.get('selector') or scope, timing)
+
+    return project.fmt_file(path, lambda first_line: fmt_source, check)
+
+# Like `Fmt.extract_variables`, with the current directory as the project.
+def file_variables(settings, path):
+    vars = {'folder': os.getcwd()}
+    vars.update(core.file_variables(path))
+    vars.update(core.indent_variables(settings.get('tab_size', 4), settings.get('translate_tabs_to_spaces')))
+    vars.update(os.environ)
+    return vars
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""
+Optional NumPy backend for `difflib`.
+
+Sublime's plugin host doesn't ship NumPy, but it can be made available to
+plugins, and `difflib` is also usable outside of Sublime. Without NumPy,
+nothing here is used, and `difflib` runs in pure Python as before.
+
+Most of the time of a large Myers diff goes into walking the diagonals: for
+each edit distance `d`, up to `d + 1` diagonals extend their furthest reaching
+path, each in an interpreted loop. Here, the whole front is advanced at once
+with array operations. Snakes are followed a few steps at a time across all
+diagonals, and the few long ones left after that are followed one by one, by
+comparing blocks of doubling size.
+
+Each array operation has a fixed overhead, so this only pays off for wide
+fronts. `difflib.middle_snake` starts in pure Python and hands over once `d`
+reaches `MIN_D`; for smaller diffs, nothing changes. `bench/accel.py` shows
+the crossover.
+"""
+
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Whether `difflib` uses this backend. Can be turned off, for comparison.
+ENABLED = numpy is not None
+
+# Edit distance at which `difflib.middle_snake` hands over to `middle_snake`.
+MIN_D = 48
+
+# Steps of following snakes across all diagonals at once, before the
+# remaining ones are followed one by one.
+SNAKE_STEPS = 4
+
+# Returns array views of two strings or arrays of tokens, for `middle_snake`.
+# Strings are converted to arrays of code points.
+def sequences(text1, text2):
+    return (sequence(text1), sequence(text2))
+
+def sequence(text):
+    if isinstance(text, str):
+        return numpy.frombuffer(text.encode('utf-32-le', 'surrogatepass'), dtype='<u4')
+    return numpy.frombuffer(text, dtype=numpy.dtype(text.typecode))
+
+def middle_snake(seqs, lo1, hi1, lo2, hi2, v1, v2, deadline, d, k1start, k1end, k2start, k2end):
+    """Continue `difflib.middle_snake` from edit distance `d`, given the
+    state of its loop at that point.
+
+    Args:
+        seqs: Result of `sequences` for the texts.
+        d, k1start, k1end, k2start, k2end: Loop state of
+            `difflib.middle_snake`.
+        Others as in `difflib.middle_snake`.
+
+    Returns:
+        Same as `difflib.middle_snake`.
+    """
+    (seq1, seq2) = seqs
+    # The reverse path walks the reversed ranges the same way the front path
+    # walks the ranges.
+    front1 = seq1[lo1:hi1]
+    front2 = seq2[lo2:hi2]
+    back1 = front1[::-1]
+    back2 = front2[::-1]
+    text1_length = hi1 - lo1
+    text2_length = hi2 - lo2
+    max_d = (text1_length + text2_length + 1) // 2
+    v_offset = max_d
+    v_length = 2 * max_d
+    delta = text1_length - text2_length
+    front = (delta % 2 != 0)
+    vv1 = numpy.frombuffer(v1, dtype=numpy.dtype(v1.typecode))
+    vv2 = numpy.frombuffer(v2, dtype=numpy.dtype(v2.typecode))
+    try:
+        for d in range(d, max_d):
+            # Bail out if deadline is reached.
+            if deadline is not None and time.perf_counter() > deadline:
+                break
+
+            # Walk the front path one step.
+            (ks, xs, inside, k1start, k1end) = walk(vv1, front1, front2, d, k1start, k1end, v_offset)
+            if front:
+                i = overlap(ks, xs, inside, vv2, v_offset, v_length, delta, text1_length)
+                if i is not None:
+                    x1 = int(xs[i])
+                    return (lo1 + x1, lo2 + x1 - int(ks[i]))
+
+            # Walk the reverse path one step.
+            (ks, xs, inside, k2start, k2end) = walk(vv2, back1, back2, d, k2start, k2end, v_offset)
+            if not front:
+                i = overlap(ks, xs, inside, vv1, v_offset, v_length, delta, text1_length)
+                if i is not None:
+                    k1_offset = v_offset + delta - int(ks[i])
+                    x1 = int(vv1[k1_offset])
+                    return (lo1 + x1, lo2 + v_offset + x1 - k1_offset)
+
+        return None
+    finally:
+        vv1[max(0, v_offset - d):v_offset + d + 2] = -1
+        vv2[max(0, v_offset - d):v_offset + d + 2] = -1
+
+def walk(v, seq1, seq2, d, kstart, kend, v_offset):
+    """Advance a path by one edit on all of its diagonals.
+
+    Returns:
+        Tuple of the diagonals, the furthest x reached on each, a mask of
+        those still inside the graph, and the updated kstart and kend.
+    """
+    ks = numpy.arange(-d + kstart, d + 1 - kend, 2)
+    offsets = ks + v_offset
+    left = v[offsets - 1]
+    right = v[offsets + 1]
+    xs = numpy.where((ks == -d) | ((ks != d) & (left < right)), right, left + 1)
+    follow_snakes(seq1, seq2, xs, ks)
+    v[offsets] = xs
+    # Ran off the end or the start of the graph.
+    off_end = xs > len(seq1)
+    off_start = ~off_end & (xs - ks > len(seq2))
+    kend += 2 * int(numpy.count_nonzero(off_end))
+    kstart += 2 * int(numpy.count_nonzero(off_start))
+    return (ks, xs, ~(off_end | off_start), kstart, kend)
+
+def follow_snakes(seq1, seq2, xs, ks):
+    """Advance every x in `xs` along its diagonal while the sequences are
+    equal, in place."""
+    (size1, size2) = (len(seq1), len(seq2))
+    live = numpy.flatnonzero((xs < size1) & (xs - ks < size2))
+    for _ in range(SNAKE_STEPS):
+        if not live.size:
+            return
+        x = xs[live]
+        live = live[seq1[x] == seq2[x - ks[live]]]
+        xs[live] += 1
+        x = xs[live]
+        live = live[(x < size1) & (x - ks[live] < size2)]
+    for i in live.tolist():
+        x = int(xs[i])
+        xs[i] = x + prefix_length(seq1, x, seq2, x - int(ks[i]))
+
+def prefix_length(seq1, start1, seq2, start2):
+    """Determine the common prefix of seq1[start1:] and seq2[start2:], by
+    comparing blocks of doubling size."""
+    size = min(len(seq1) - start1, len(seq2) - start2)
+    (length, step) = (0, 64)
+    while length < size:
+        step = min(step, size - length)
+        unequal = numpy.flatnonzero(
+            seq1[start1 + length:start1 + length + step] !=
+            seq2[start2 + length:start2 + length + step]
+        )
+        if unequal.size:
+            return length + int(unequal[0])
+        length += step
+        step *= 2
+    return size
+
+def overlap(ks, xs, inside, other, v_offset, v_length, delta, text1_length):
+    """Find the first diagonal on which a path meets the opposite path.
+
+    Returns:
+        Index into `ks`, or None.
+    """
+    mirrors = v_offset + delta - ks
+    candidates = numpy.flatnonzero(inside & (mirrors >= 0) & (mirrors < v_length))
+    other_xs = other[mirrors[candidates]]
+    hits = candidates[(other_xs != -1) & (xs[candidates] + other_xs >= text1_length)]
+    return int(hits[0]) if hits.size else None
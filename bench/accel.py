@@ -0,0 +1,76 @@
+"""
+Crossover of the optional NumPy backend of `difflib`, see `accel.py`.
+
+    python3 bench/accel.py [--sizes 1000,10000] [--rates 0.001,0.01,0.1] [--repeat 3]
+
+For every size (in lines) and rate of changed lines, times `bisect_spans`
+over line tokens, and over characters for sizes up to `--max-char-lines`,
+with the backend disabled and enabled. The backend only engages once the edit
+distance of a split reaches `accel.MIN_D`, so diffs smaller than that should
+run at the same speed either way; the speedup column shows where it starts to
+pay off.
+"""
+
+import argparse
+import random
+import sys
+
+import common
+import corpus
+
+common.load_package()
+from Fmt import accel
+from Fmt import difflib
+
+def edit(size, rate, seed=0):
+    rand = random.Random(seed)
+    old = corpus.source(size, seed)
+    new = ''.join(
+        line.rstrip('\n') + ' // changed\n' if rand.random() < rate else line
+        for line in old.splitlines(True)
+    )
+    return (old, new)
+
+def timed(enabled, fun, repeat):
+    prev = accel.ENABLED
+    accel.ENABLED = enabled
+    try:
+        return min(common.measure(fun, repeat))
+    finally:
+        accel.ENABLED = prev
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='1000,10000')
+    parser.add_argument('--rates', default='0.001,0.01,0.1')
+    parser.add_argument('--max-char-lines', type=int, default=1000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    if not accel.ENABLED:
+        print('NumPy is not available, nothing to compare')
+        return
+
+    print('MIN_D = {}'.format(accel.MIN_D))
+    print('{:<8}{:>8}{:>8}{:>11}{:>11}{:>9}'.format('input', 'lines', 'rate', 'python', 'numpy', 'speedup'))
+    for size in [int(size) for size in args.sizes.split(',')]:
+        for rate in [float(rate) for rate in args.rates.split(',')]:
+            (old, new) = edit(size, rate)
+            (tokens1, _, tokens2, _) = difflib.lines_to_tokens(old, new)
+            cases = [('lines', tokens1, tokens2)]
+            if size <= args.max_char_lines:
+                cases.append(('chars', old, new))
+
+            for (name, seq1, seq2) in cases:
+                def run():
+                    difflib.bisect_spans(seq1, seq2, difflib.NO_DEADLINE)
+
+                python = timed(False, run, args.repeat)
+                numpy = timed(True, run, args.repeat)
+                print('{:<8}{:>8}{:>8}{:>11}{:>11}{:>8.2f}x'.format(
+                    name, size, rate, common.fmt_duration(python), common.fmt_duration(numpy), python / numpy,
+                ))
+                sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Shared helpers for the benchmarks. Run benchmarks from the repository root:
+
+    python3 bench/launch.py
+
+The plugin's modules are imported as the package `Fmt`, regardless of the
+name of the directory. `Fmt.py` itself requires the Sublime API; benchmarks
+that exercise it install a minimal stand-in via `install_sublime_stub`.
+"""
+
+import importlib.machinery
+import importlib.util
+import os
+import statistics
+import sys
+import time
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def load_package():
+    if 'Fmt' not in sys.modules:
+        spec = importlib.machinery.ModuleSpec('Fmt', None, is_package=True)
+        spec.submodule_search_locations = [ROOT]
+        sys.modules['Fmt'] = importlib.util.module_from_spec(spec)
+    return sys.modules['Fmt']
+
+# Provides just enough of `sublime` and `sublime_plugin` for importing
+# `Fmt.py` and calling its merge functions with a stub view. Does nothing when
+# running inside Sublime.
+def install_sublime_stub():
+    try:
+        import sublime
+        return
+    except ImportError:
+        pass
+
+    class Region(object):
+        def __init__(self, a, b=None):
+            self.a = a
+            self.b = a if b is None else b
+
+        def begin(self):
+            return min(self.a, self.b)
+
+        def end(self):
+            return max(self.a, self.b)
+
+        def empty(self):
+            return self.a == self.b
+
+    sublime = types.ModuleType('sublime')
+    sublime.Region = Region
+    sublime.set_timeout = lambda fun, delay=0: fun()
+    sys.modules['sublime'] = sublime
+
+    sublime_plugin = types.ModuleType('sublime_plugin')
+    for name in ('EventListener', 'ViewEventListener', 'TextChangeListener', 'TextCommand', 'WindowCommand'):
+        setattr(sublime_plugin, name, type(name, (object,), {}))
+    sys.modules['sublime_plugin'] = sublime_plugin
+
+# Calls `fun` `count` times, returns the list of durations in seconds.
+def measure(fun, count):
+    times = []
+    for _ in range(count):
+        start = time.perf_counter()
+        fun()
+        times.append(time.perf_counter() - start)
+    return times
+
+def report(name, times):
+    print('{:<40} n={:<5} min={:>9} p50={:>9} mean={:>9} max={:>9}'.format(
+        name,
+        len(times),
+        fmt_duration(min(times)),
+        fmt_duration(statistics.median(times)),
+        fmt_duration(statistics.mean(times)),
+        fmt_duration(max(times)),
+    ))
+
+def fmt_duration(secs):
+    if secs < 1e-3:
+        return '{:.1f}µs'.format(secs * 1e6)
+    if secs < 1:
+        return '{:.2f}ms'.format(secs * 1e3)
+    return '{:.2f}s'.format(secs)
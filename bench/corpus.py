@@ -0,0 +1,114 @@
+"""
+Synthetic source files and formatter-like edits of them, for the diff
+benchmarks. Everything is deterministic for a given seed.
+
+Each edit returns `(old, new)`, where `old` is unformatted source and `new` is
+what a formatter would plausibly produce.
+"""
+
+import random
+
+IDENTS = [
+    'value', 'count', 'result', 'buffer', 'offset', 'index', 'node', 'item',
+    'config', 'handler', 'request', 'response', 'err', 'ctx', 'key', 'size',
+]
+
+PACKAGES = [
+    'bytes', 'context', 'errors', 'fmt', 'io', 'net/http', 'os', 'path',
+    'sort', 'strconv', 'strings', 'sync', 'time', 'unicode/utf8',
+]
+
+def source(line_count, seed=0, indent='\t'):
+    rand = random.Random(seed)
+    lines = ['package main', '', 'import (']
+    lines.extend('{}"{}"'.format(indent, name) for name in PACKAGES)
+    lines.extend([')', ''])
+
+    while len(lines) < line_count:
+        lines.extend(func(rand, indent))
+
+    return '\n'.join(lines[:line_count]) + '\n'
+
+def func(rand, indent):
+    name = rand.choice(IDENTS) + str(rand.randrange(100000))
+    lines = ['func {}({} int) int {{'.format(name, rand.choice(IDENTS))]
+    for _ in range(rand.randrange(3, 12)):
+        kind = rand.randrange(4)
+        a = rand.choice(IDENTS)
+        b = rand.choice(IDENTS)
+        if kind == 0:
+            lines.append('{}{} := {} + {}'.format(indent, a, b, rand.randrange(1000)))
+        elif kind == 1:
+            lines.append('{}if {} > {} {{'.format(indent, a, b))
+            lines.append('{}{}return {}'.format(indent, indent, a))
+            lines.append('{}}}'.format(indent))
+        elif kind == 2:
+            lines.append('{}{} = call({}, {})'.format(indent, a, b, rand.randrange(100)))
+        else:
+            lines.append('{}items := []int{{'.format(indent))
+            for _ in range(rand.randrange(1, 4)):
+                lines.append('{}{}{},'.format(indent, indent, rand.randrange(1000)))
+            lines.append('{}{}{}'.format(indent, indent, rand.randrange(1000)))
+            lines.append('{}}}'.format(indent))
+    lines.append('{}return 0'.format(indent))
+    lines.extend(['}', ''])
+    return lines
+
+# Formatted source with indentation changed, as if the indent settings
+# changed, in a fraction of the functions.
+def reindent(line_count, seed=0, fraction=0.3):
+    rand = random.Random(seed)
+    new = source(line_count, seed)
+    out = []
+    touched = False
+    for line in new.split('\n'):
+        if line.startswith('func '):
+            touched = rand.random() < fraction
+        out.append(line.replace('\t', '    ') if touched else line)
+    return ('\n'.join(out), new)
+
+# Imports in the wrong order.
+def reorder_imports(line_count, seed=0):
+    rand = random.Random(seed)
+    new = source(line_count, seed)
+    lines = new.split('\n')
+    start = lines.index('import (') + 1
+    end = lines.index(')', start)
+    block = lines[start:end]
+    rand.shuffle(block)
+    lines[start:end] = block
+    return ('\n'.join(lines), new)
+
+# Missing trailing commas in multi-line literals.
+def trailing_commas(line_count, seed=0, fraction=0.5):
+    rand = random.Random(seed)
+    new = source(line_count, seed)
+    lines = new.split('\n')
+    old = list(lines)
+    for (i, line) in enumerate(lines[:-1]):
+        if line.endswith(',') and lines[i + 1].strip() == '}' and rand.random() < fraction:
+            old[i] = line[:-1]
+    # The formatter adds a trailing comma after the last element.
+    for (i, line) in enumerate(lines[:-1]):
+        if lines[i + 1].strip() == '}' and line.startswith('\t\t') and not line.endswith(','):
+            if rand.random() < fraction:
+                lines[i] = line + ','
+    return ('\n'.join(old), '\n'.join(lines))
+
+# Trailing whitespace and irregular spacing around operators.
+def whitespace_churn(line_count, seed=0, fraction=0.2):
+    rand = random.Random(seed)
+    new = source(line_count, seed)
+    old = []
+    for line in new.split('\n'):
+        if line and rand.random() < fraction:
+            line = line.replace(' := ', ':=').replace(' + ', '+') + ' ' * rand.randrange(1, 4)
+        old.append(line)
+    return ('\n'.join(old), new)
+
+EDITS = [
+    ('reindent', reindent),
+    ('reorder_imports', reorder_imports),
+    ('trailing_commas', trailing_commas),
+    ('whitespace_churn', whitespace_churn),
+]
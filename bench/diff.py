@@ -0,0 +1,211 @@
+"""
+Benchmarks for `difflib` and for applying diffs to a view.
+
+    python3 bench/diff.py [--sizes 1000,10000] [--repeat 3] [--memory] [--filter NAME]
+
+For every synthetic edit in `corpus.py` and every size (in lines), measures:
+
+    myers_diffs           -- with the shipped MAX_DIFFS_THRESHOLD and no
+                             deadline; may end in TooManyDiffs
+    myers_unbounded       -- same, without the threshold
+    line_mode_diffs       -- line-level pass with char-level rediff
+    engine:<name>         -- every engine registered in `difflib.ENGINES`,
+                             producing spans; the result is checked for
+                             correctness outside of the measurement
+    line_diffs            -- patience line diff materialized as `Diff`
+                             tuples, for comparison with engine:patience
+    bisect_lines          -- bisect over the line tokens
+    cleanup_efficiency    -- on the unbounded diff
+    cleanup_merge         -- on the unbounded diff
+    merge_into_view       -- diff + cleanup + apply through a stub view, which
+                             counts API calls
+    merge_region_into_view -- same, for the edit as a region between
+                             `FILLER_LINES` unchanged lines on either side;
+                             should take as long as merge_into_view
+    merge_engine_into_view -- patience line diff + apply through a stub view
+
+Reports the best time of `--repeat` runs, and with `--memory`, the peak
+traced allocation of one more run.
+"""
+
+import argparse
+import functools
+import sys
+import tracemalloc
+
+import common
+import corpus
+
+common.install_sublime_stub()
+common.load_package()
+from Fmt import difflib
+from Fmt import Fmt
+from Fmt import stats
+
+import sublime
+
+UNBOUNDED = float('inf')
+
+FILLER_LINES = 20000
+
+class StubView(object):
+    def __init__(self, text):
+        self.text = text
+        self.calls = 0
+
+    def id(self):
+        return id(self)
+
+    def size(self):
+        return len(self.text)
+
+    def substr(self, region):
+        self.calls += 1
+        return self.text[region.begin():region.end()]
+
+    def insert(self, edit, point, text):
+        self.calls += 1
+        self.text = self.text[:point] + text + self.text[point:]
+        return len(text)
+
+    def erase(self, edit, region):
+        self.calls += 1
+        self.text = self.text[:region.begin()] + self.text[region.end():]
+
+    def replace(self, edit, region, text):
+        self.calls += 1
+        self.text = self.text[:region.begin()] + text + self.text[region.end():]
+
+    def viewport_position(self):
+        return (0, 0)
+
+    def set_viewport_position(self, position, animate=True):
+        pass
+
+def with_threshold(threshold, fun):
+    def run():
+        prev = difflib.MAX_DIFFS_THRESHOLD
+        difflib.MAX_DIFFS_THRESHOLD = threshold
+        try:
+            return fun()
+        finally:
+            difflib.MAX_DIFFS_THRESHOLD = prev
+    return run
+
+def cases(old, new):
+    (tokens1, _, tokens2, _) = difflib.lines_to_tokens(old, new)
+
+    # Computed on demand, since it's slow for large inputs.
+    memo = []
+
+    def unbounded():
+        if not memo:
+            memo.append(with_threshold(UNBOUNDED, lambda: difflib.myers_diffs(old, new))())
+        return list(memo[0])
+
+    def myers():
+        try:
+            return '{} ops'.format(len(difflib.myers_diffs(old, new)))
+        except difflib.TooManyDiffsException:
+            return 'TooManyDiffs'
+
+    def merge():
+        view = StubView(old)
+        Fmt.merge_into_view(view, None, old, new, sublime.Region(0, view.size()), stats.Timing())
+        assert view.text == new, 'merge_into_view produced wrong text'
+        return '{} view calls'.format(view.calls)
+
+    def merge_region():
+        filler = filler_text()
+        view = StubView(filler + old + filler)
+        region = sublime.Region(len(filler), len(filler) + len(old))
+        Fmt.merge_into_view(view, None, old, new, region, stats.Timing())
+        assert view.text == filler + new + filler, 'merge_into_view produced wrong text'
+        return '{} view calls'.format(view.calls)
+
+    def merge_engine():
+        view = StubView(old)
+        Fmt.merge_engine_into_view(view, None, old, new, sublime.Region(0, view.size()), stats.Timing(), 'patience')
+        assert view.text == new, 'merge_engine_into_view produced wrong text'
+        return '{} view calls'.format(view.calls)
+
+    def engine(name):
+        return lambda: '{} spans'.format(len(difflib.engine_spans(name, old, new)))
+
+    def check_engine(name):
+        return lambda: check_diffs(difflib.engine_diffs(name, old, new), old, new)
+
+    return [
+        ('myers_diffs', myers),
+        ('myers_unbounded', with_threshold(UNBOUNDED, lambda: '{} ops'.format(len(difflib.myers_diffs(old, new))))),
+        ('line_mode_diffs', with_threshold(UNBOUNDED, lambda: '{} ops'.format(len(difflib.line_mode_diffs(old, new))))),
+    ] + [
+        ('engine:' + name, engine(name), check_engine(name)) for name in sorted(difflib.ENGINES)
+    ] + [
+        ('line_diffs', lambda: '{} ops'.format(len(difflib.line_diffs(old, new)))),
+        ('bisect_lines', with_threshold(UNBOUNDED, lambda: '{} spans'.format(len(difflib.bisect_spans(tokens1, tokens2))))),
+        ('cleanup_efficiency', lambda: difflib.cleanup_efficiency(unbounded()), unbounded),
+        ('cleanup_merge', lambda: difflib.cleanup_merge(unbounded()), unbounded),
+        ('merge_into_view', with_threshold(UNBOUNDED, merge)),
+        ('merge_region_into_view', with_threshold(UNBOUNDED, merge_region)),
+        ('merge_engine_into_view', merge_engine),
+    ]
+
+@functools.lru_cache(maxsize=None)
+def filler_text():
+    return corpus.source(FILLER_LINES, seed=1)
+
+def check_diffs(diffs, old, new):
+    assert ''.join(text for (op, text) in diffs if op != difflib.Ops.INSERT) == old, 'diff does not reproduce old text'
+    assert ''.join(text for (op, text) in diffs if op != difflib.Ops.DELETE) == new, 'diff does not reproduce new text'
+
+def peak_memory(fun):
+    tracemalloc.start()
+    try:
+        fun()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def fmt_bytes(size):
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1024:
+            return '{:.1f}{}'.format(size, unit)
+        size /= 1024
+    return '{:.1f}GiB'.format(size)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='1000,10000')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--memory', action='store_true')
+    parser.add_argument('--filter', default='')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    print('{:<18}{:>8}  {:<24}{:>11}{:>12}  {}'.format('edit', 'lines', 'bench', 'time', 'peak mem', 'outcome'))
+    for (edit_name, edit) in corpus.EDITS:
+        for size in sizes:
+            (old, new) = edit(size)
+            for case in cases(old, new):
+                (name, fun) = case[:2]
+                if args.filter not in name:
+                    continue
+                # Untimed setup.
+                if len(case) > 2:
+                    case[2]()
+                outcome = [None]
+
+                def run():
+                    outcome[0] = fun()
+
+                time = min(common.measure(run, args.repeat))
+                memory = fmt_bytes(peak_memory(run)) if args.memory else '-'
+                print('{:<18}{:>8}  {:<24}{:>11}{:>12}  {}'.format(
+                    edit_name, size, name, common.fmt_duration(time), memory, outcome[0] or '',
+                ))
+                sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+"""
+Compares process launch strategies for a formatter command.
+
+    python3 bench/launch.py [count] [cmd...]
+
+Defaults to 200 launches of `true`. Each launch writes nothing to stdin and
+waits for exit. "popen_*" measure plain `subprocess.Popen`, as Fmt used to
+launch formatters; "launch_*" measure `launch.popen`, as Fmt does now, which
+resolves the executable from a cache instead of searching PATH. Fmt only
+launches without a CWD with "cwd_mode": "none".
+"""
+
+import os
+import subprocess as sub
+import sys
+import tempfile
+
+import common
+
+common.load_package()
+from Fmt import launch
+
+def popen_plain(cmd, cwd):
+    return sub.Popen(args=cmd, stdin=sub.PIPE, stdout=sub.PIPE, stderr=sub.PIPE, cwd=cwd)
+
+def run(spawn, cmd, cwd):
+    def fun():
+        proc = spawn(cmd, cwd)
+        proc.communicate(b'')
+    return fun
+
+def main():
+    args = sys.argv[1:]
+    count = int(args.pop(0)) if args else 200
+    cmd = args or ['true']
+    cwd = tempfile.gettempdir()
+
+    # Warm up the executable cache and the OS page cache.
+    run(launch.popen, cmd, None)()
+
+    strategies = [
+        ('popen_path_search', popen_plain, None),
+        ('popen_path_search_cwd', popen_plain, cwd),
+        ('launch_resolved', launch.popen, None),
+        ('launch_resolved_cwd', launch.popen, cwd),
+    ]
+
+    print('cmd={} pid={} rss_hint={}'.format(cmd, os.getpid(), rss_hint()))
+    for (name, spawn, cwd) in strategies:
+        common.report(name, common.measure(run(spawn, cmd, cwd), count))
+
+# Fork cost grows with the size of the parent process, so it's worth knowing.
+def rss_hint():
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmRSS:'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return 'unknown'
+
+if __name__ == '__main__':
+    main()
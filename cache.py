@@ -0,0 +1,187 @@
+"""
+Cache of formatter output, keyed by a hash of the input and of everything that
+could affect the output: the command, env, CWD, and a fingerprint of the
+executable, which changes when the formatter is upgraded.
+
+Two tiers: an in-memory LRU, and an optional on-disk store. Both are bounded by
+total size of cached text; the least recently used entries are evicted first.
+"""
+
+import collections
+import hashlib
+import os
+import threading
+
+class Cache(object):
+    def __init__(self, max_size=0, dir=None, max_dir_size=0):
+        self.max_size = max_size
+        self.dir = dir
+        self.max_dir_size = max_dir_size
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.dir_size = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def configure(self, max_size, dir, max_dir_size):
+        with self.lock:
+            self.max_size = max_size or 0
+            self.max_dir_size = max_dir_size or 0
+            if dir != self.dir:
+                self.dir = dir
+                self.dir_size = None
+            self.evict()
+
+    def get(self, key):
+        with self.lock:
+            val = self.entries.get(key)
+            if val is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return val
+
+        val = self.read_disk(key)
+        with self.lock:
+            if val is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self.put_mem(key, val)
+            return val
+
+    def put(self, key, val):
+        with self.lock:
+            self.put_mem(key, val)
+        self.write_disk(key, val)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.hits = self.disk_hits = self.misses = 0
+
+    def put_mem(self, key, val):
+        if not self.max_size:
+            return
+        prev = self.entries.pop(key, None)
+        if prev is not None:
+            self.size -= len(prev)
+        self.entries[key] = val
+        self.size += len(val)
+        self.evict()
+
+    def evict(self):
+        while self.entries and self.size > self.max_size:
+            (_, val) = self.entries.popitem(last=False)
+            self.size -= len(val)
+
+    def disk_path(self, key):
+        return os.path.join(self.dir, key[:2], key)
+
+    def read_disk(self, key):
+        if not self.dir or not self.max_dir_size:
+            return None
+        path = self.disk_path(key)
+        try:
+            with open(path, 'rb') as file:
+                val = file.read().decode('utf-8')
+            # Bump mtime for LRU eviction.
+            os.utime(path)
+            return val
+        except (OSError, ValueError):
+            return None
+
+    def write_disk(self, key, val):
+        if not self.dir or not self.max_dir_size:
+            return
+        path = self.disk_path(key)
+        temp_path = path + '.' + str(threading.get_ident()) + '.tmp'
+        data = val.encode('utf-8')
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(temp_path, 'wb') as file:
+                file.write(data)
+            os.replace(temp_path, path)
+        except OSError:
+            return
+
+        with self.lock:
+            if self.dir_size is None:
+                self.dir_size = dir_size(self.dir)
+            else:
+                self.dir_size += len(data)
+            if self.dir_size > self.max_dir_size:
+                self.dir_size = evict_dir(self.dir, self.max_dir_size * 3 // 4)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'size': self.size,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+            }
+
+# Hash of the invocation settings that affect the output. Computed once per
+# invocation plan, rather than for every input.
+def config_digest(cmd, cwd, env):
+    parts = [cwd or '']
+    parts.extend(cmd)
+    if env is not None:
+        for (key, val) in sorted(env.items()):
+            parts.append(key + '=' + val)
+    return hash_parts(parts)
+
+# The executable is fingerprinted on every call, because it may be upgraded at
+# any time.
+def cache_key(input, encoding, exe, digest, extra=None):
+    return hash_parts([input, encoding, exe_fingerprint(exe), digest, extra or ''])
+
+def hash_parts(parts):
+    hash = hashlib.sha256()
+    for part in parts:
+        hash.update(part.encode('utf-8', 'surrogatepass'))
+        hash.update(b'\0')
+    return hash.hexdigest()
+
+def exe_fingerprint(exe):
+    try:
+        stat = os.stat(exe)
+    except OSError:
+        return exe
+    return '{}:{}:{}'.format(exe, stat.st_mtime_ns, stat.st_size)
+
+def dir_size(dir):
+    size = 0
+    for (_, stat) in walk_files(dir):
+        size += stat.st_size
+    return size
+
+# Removes the least recently used files until the total size is under the
+# limit. Returns the new total size.
+def evict_dir(dir, max_size):
+    files = sorted(walk_files(dir), key=lambda entry: entry[1].st_mtime)
+    size = sum(stat.st_size for (_, stat) in files)
+    for (path, stat) in files:
+        if size <= max_size:
+            break
+        try:
+            os.remove(path)
+            size -= stat.st_size
+        except OSError:
+            pass
+    return size
+
+def walk_files(dir):
+    out = []
+    for (root, _, names) in os.walk(dir):
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                out.append((path, os.stat(path)))
+            except OSError:
+                pass
+    return out
@@ -0,0 +1,538 @@
+"""
+The editor-independent part of Fmt: resolving settings and rules for a scope,
+invoking formatters, and merging their output into a buffer. Driven by the
+plugin, `Fmt.py`, and by the headless runner, `__main__.py`, which provide
+what differs between them:
+
+    score    -- `score(scope, selector)`, like `sublime.score_selector`;
+                `score_selector` is a stand-in. See `Rules`.
+    expand   -- `expand(val, variables)`, like `sublime.expand_variables`;
+                `expand_variables` is a stand-in. See `Plan`.
+    settings -- settings resolved for a scope, with `get(key)`, as from
+                `ViewSettings.resolve`.
+    buffer   -- text being formatted, with `size()` and
+                `replace(start, end, text)`. See `merge_diff`.
+
+Only `Fmt.py` uses the Sublime API. The other modules of the package,
+including this one, must not, so that they also run without Sublime, as in
+`__main__.py` and the benchmarks.
+"""
+
+import json
+import os
+import re
+import subprocess as sub
+from . import cache
+from . import daemon
+from . import difflib
+from . import dirty
+from . import launch
+from . import stats
+from . import stream
+
+IS_WINDOWS = os.name == 'nt'
+
+# Inputs longer than this many characters are streamed to and from the
+# formatter instead of being buffered whole.
+STREAM_THRESHOLD = 1 << 20
+
+# Diff hunks separated by at most this many unchanged characters are applied
+# as one replacement, rewriting the characters between them. Each replacement
+# is a separate call to the buffer. Rewriting unchanged characters would move
+# cursors and selections in them, so only directly adjacent deletions and
+# insertions are merged.
+EDIT_GAP = 0
+
+DAEMONS = daemon.Pool()
+
+CACHE = cache.Cache()
+
+STATS = stats.Stats()
+
+# Matches "$name", "${name}", "${name:default}", and "\$" as an escape.
+VARIABLE = re.compile(r'\\(\$)|\$(\w+)|\$\{(\w+)(?::([^}]*))?\}')
+
+# Matches strings, which are kept, and comments, for `load_settings`.
+SETTINGS_COMMENT = re.compile(r'("(?:[^"\\]|\\.)*")|//[^\n]*|/\*.*?\*/', re.S)
+
+# Matches strings, which are kept, and trailing commas, for `load_settings`.
+SETTINGS_COMMA = re.compile(r'("(?:[^"\\]|\\.)*")|,(?=\s*[\]}])')
+
+# TODO: any other exception type should be printed with the stack. Only error
+# messages generated by Fmt, as `ErrMsg`, should have the stack suppressed
+# (which is the default behavior of `str.format`).
+class ErrMsg(Exception):
+    pass
+
+# `settings` are resolved for the scope of the plan. `rows` are passed to the
+# formatter via "$dirty_*" variables; see `Plan.command`. A `schedule.Job`
+# makes the format raise `schedule.Cancelled` and kill the formatter when the
+# job is cancelled.
+def fmt(plan, settings, input, encoding, timing=None, rows=None, job=None):
+    if timing is None:
+        timing = stats.Timing()
+
+    with timing.phase('settings'):
+        cmd = plan.command(input, rows)
+        use_cache = configure_cache(settings)
+
+    key = None
+    if use_cache:
+        with timing.phase('cache'):
+            key = plan.cache_key(input, encoding, cmd)
+            fmted = CACHE.get(key)
+        if fmted is not None:
+            timing.event('cache_hit')
+            return fmted
+        timing.event('cache_miss')
+
+    if job is not None:
+        job.check()
+
+    # Daemons are shared, so their requests aren't interrupted; only the
+    # result is dropped.
+    if plan.mode == 'daemon':
+        with timing.phase('formatter'):
+            fmted = fmt_daemon(input, settings, plan)
+    else:
+        fmted = fmt_process(input, encoding, settings, plan, cmd, timing, job)
+
+    if job is not None:
+        job.check()
+
+    if key is not None:
+        CACHE.put(key, fmted)
+        # Formatters are expected to be idempotent: formatting the output
+        # again must produce the same output. This makes subsequent saves of
+        # an unchanged file free. Line ranges of the input don't apply to
+        # the output.
+        if fmted != input and not plan.templates:
+            CACHE.put(plan.cache_key(fmted, encoding, cmd), fmted)
+
+    return fmted
+
+class Plan(object):
+    """Everything needed to invoke the formatter for a given file and scope,
+    other than the input: the expanded command, CWD and env. Computing it
+    involves expanding variables and copying the environment, so callers
+    reuse it until something it depends on changes.
+
+    Args:
+        settings: Settings resolved for `scope`.
+        scope: Scope of the input, for error messages.
+        variables: Function returning the substitution variables; only
+            called when the command has any.
+        cwd: CWD of the formatter, as from `guess_cwd`.
+        file: Path of the file being formatted, or None.
+        expand: Function substituting variables, like `expand_variables`.
+    """
+    def __init__(self, settings, scope, variables, cwd, file, expand):
+        cmd = settings.get('cmd')
+
+        if not cmd:
+            raise ErrMsg('unable to find setting "cmd" for scope "{}"'.format(scope))
+
+        # Support "$variable" substitutions. Arguments with "$dirty_*"
+        # variables are kept as templates and expanded for every format
+        # instead, by `command`.
+        templates = {}
+        vals = None
+        if any('$' in arg for arg in cmd):
+            vals = variables()
+            templates = {index: arg for (index, arg) in enumerate(cmd) if dirty.uses_variables(arg)}
+            cmd = [
+                arg if index in templates else expand(arg, vals)
+                for (index, arg) in enumerate(cmd)
+            ]
+
+        mode = settings.get('mode') or 'process'
+        if mode not in ('process', 'daemon'):
+            raise ErrMsg('unknown value of setting "mode": {}'.format(mode))
+        if templates and mode == 'daemon':
+            raise ErrMsg('"$dirty_*" variables are not supported with "mode": "daemon"')
+
+        self.cmd = cmd
+        self.templates = templates
+        self.variables = vals if templates else None
+        self.expand = expand
+        self.mode = mode
+        self.cwd = cwd
+        self.env = make_env(settings.get('env'))
+        self.digest = cache.config_digest(self.cmd, self.cwd, self.env)
+
+        # Daemons receive the file name, which may affect the output.
+        self.file = file if mode == 'daemon' else None
+
+    # Returns the command for formatting `input`, with "$dirty_*" variables
+    # describing `rows` of it, or all of it.
+    def command(self, input, rows=None):
+        if not self.templates:
+            return self.cmd
+        variables = dict(self.variables)
+        variables.update(dirty.range_variables(input, rows))
+        cmd = list(self.cmd)
+        for (index, arg) in self.templates.items():
+            cmd[index] = self.expand(arg, variables)
+        return cmd
+
+    # `cmd` is the result of `command`. Only its templated arguments differ
+    # between formats, so only those are added to `digest`.
+    def cache_key(self, input, encoding, cmd):
+        exe = launch.resolve_exe(self.cmd[0], self.env)
+        # Relative paths are relative to the formatter's CWD.
+        if self.cwd and not os.path.isabs(exe) and launch.has_dir(exe):
+            exe = os.path.join(self.cwd, exe)
+        extra = self.file
+        if self.templates:
+            extra = '\0'.join([self.file or ''] + [cmd[index] for index in sorted(self.templates)])
+        return cache.cache_key(input, encoding, exe, self.digest, extra)
+
+def fmt_process(input, encoding, settings, plan, cmd, timing, job=None):
+    timeout = settings.get('timeout')
+
+    with timing.phase('spawn'):
+        proc = launch.popen(cmd, plan.cwd, plan.env, process_startup_info())
+
+    try:
+        if job is not None:
+            job.attach(proc)
+        # Streaming interleaves encoding and decoding with the formatter's
+        # work, so they're not measured separately.
+        if len(input) > STREAM_THRESHOLD:
+            with timing.phase('formatter'):
+                (stdout, stderr) = stream.communicate(proc, input, encoding, timeout)
+        else:
+            with timing.phase('encode'):
+                input = bytes(input, encoding=encoding)
+            with timing.phase('formatter'):
+                (stdout, stderr) = proc.communicate(input=input, timeout=timeout)
+            with timing.phase('decode'):
+                stdout = stdout.decode(encoding)
+                stderr = stderr.decode(encoding)
+    finally:
+        if job is not None:
+            job.detach()
+        launch.kill(proc)
+
+    # A cancelled formatter was killed; its exit status is meaningless.
+    if job is not None:
+        job.check()
+
+    if proc.returncode != 0:
+        msg = str(sub.CalledProcessError(proc.returncode, cmd))
+        if len(stderr) > 0:
+            msg += ':\n' + stderr
+        elif len(stdout) > 0:
+            msg += ':\n' + stdout
+        raise ErrMsg(msg)
+
+    if len(stdout) == 0 and len(stderr) > 0:
+        raise ErrMsg(stderr)
+
+    return stdout
+
+# Daemons exchange JSON, which is always UTF-8; the buffer encoding is
+# irrelevant.
+def fmt_daemon(input, settings, plan):
+    fmter = DAEMONS.get(plan.cmd, plan.cwd, plan.env, process_startup_info())
+
+    try:
+        return fmter.request(
+            input,
+            file=plan.file,
+            timeout=settings.get('timeout'),
+            idle_timeout=settings.get('daemon_idle_timeout'),
+        )
+    except daemon.DaemonErr as err:
+        raise ErrMsg(str(err))
+
+# Applies the cache settings and returns whether caching is enabled.
+def configure_cache(settings):
+    CACHE.configure(
+        megabytes(settings.get('cache_size_mb')),
+        settings.get('cache_dir') or None,
+        megabytes(settings.get('cache_dir_size_mb')),
+    )
+    return bool(CACHE.max_size or (CACHE.dir and CACHE.max_dir_size))
+
+# Diffs `source`, which must be the content of `buffer` at `offset`, against
+# `content`, and applies the result to the buffer. Only `source` is diffed,
+# so the cost depends on its size rather than on the size of the buffer.
+# `table` is a `difflib.LineTable` to reuse across diffs of the same buffer.
+#
+# Without a timeout, may raise `difflib.TooManyDiffsException`.
+def merge_diff(buffer, source, content, offset, timing, timeout_ms=None, table=None):
+    with timing.phase('diff'):
+        deadline = difflib.deadline_after(timeout_ms)
+        diffs = difflib.myers_diffs(source, content, deadline=deadline, table=table)
+        if difflib.past_deadline(deadline):
+            timing.event('diff_deadline_exceeded')
+    with timing.phase('cleanup'):
+        difflib.cleanup_efficiency(diffs)
+        spans = difflib.diff_spans(diffs)
+        del diffs
+
+    with timing.phase('apply'):
+        apply_spans(buffer, spans, content, offset)
+
+# Like `merge_diff`, but uses the given engine from `difflib.ENGINES`.
+# Line-based engines are much faster for large files.
+def merge_engine(buffer, source, content, offset, timing, engine, timeout_ms=None, table=None):
+    if engine not in difflib.ENGINES:
+        raise ErrMsg('unknown value of setting "diff_engine": {}'.format(engine))
+
+    with timing.phase('diff'):
+        deadline = difflib.deadline_after(timeout_ms)
+        spans = difflib.engine_spans(engine, source, content, deadline, table)
+        if difflib.past_deadline(deadline):
+            timing.event('diff_deadline_exceeded')
+
+    with timing.phase('apply'):
+        apply_spans(buffer, spans, content, offset)
+
+# Applies `difflib.Spans` computed from the source and `content` to the buffer,
+# where the source is expected at `offset`, as one `buffer.replace` per
+# coalesced hunk. Hunks are applied bottom-up, so that their offsets stay
+# valid.
+def apply_spans(buffer, spans, content, offset):
+    for (start1, end1, start2, end2) in reversed(difflib.edit_hunks(spans, EDIT_GAP)):
+        buffer.replace(offset+start1, offset+end1, content[start2:end2])
+
+# Copied from other plugins, haven't personally tested on Windows.
+def process_startup_info():
+    if not IS_WINDOWS:
+        return None
+    startupinfo = sub.STARTUPINFO()
+    startupinfo.dwFlags |= sub.STARTF_USESHOWWINDOW
+    startupinfo.wShowWindow = sub.SW_HIDE
+    return startupinfo
+
+# `mode` is the "cwd_mode" setting, `file` is the path of the file being
+# formatted, if any, and `folders` are the folders of the project, the first
+# one being its root.
+def guess_cwd(mode, file, folders):
+    mode = mode or ''
+
+    if mode.startswith(':'):
+        return mode[1:]
+
+    if mode == 'none':
+        return None
+
+    if mode == 'project_root':
+        if len(folders):
+            return folders[0]
+        return None
+
+    if mode == 'auto':
+        if file:
+            return os.path.dirname(file)
+        if len(folders):
+            return folders[0]
+
+# `val` is the "env" setting.
+def make_env(val):
+    if val is None:
+        return None
+    env = os.environ.copy()
+    env.update(val)
+    return env
+
+def get_in(val, *path):
+    for key in path:
+        val, ok = get(val, key)
+        if not ok:
+            return (None, False)
+    return (val, True)
+
+def get(val, key):
+    if (
+        isinstance(val, dict) and key in val
+    ) or (
+        (isinstance(val, list) or isinstance(val, tuple)) and
+        (isinstance(key, int) and len(val) > key)
+    ):
+        return (val[key], True)
+    return (None, False)
+
+class ViewSettings(object):
+    """Settings of a view, or of a file formatted without one. `overrides`
+    are the view's "Fmt" setting, if any, and `package` is a pair of the
+    package settings, with `get(key)`, and their `Rules`.
+    """
+    def __init__(self, overrides, package, score):
+        self.overrides = overrides
+        self.rules = Rules(get(overrides, 'rules')[0], score)
+        (self.settings, self.package_rules) = package
+        self.scopes = {}
+
+    def resolve(self, scope):
+        resolved = self.scopes.get(scope)
+        if resolved is None:
+            resolved = ResolvedSettings(
+                self.overrides,
+                self.rules.for_scope(scope),
+                self.settings,
+                self.package_rules.for_scope(scope),
+            )
+            self.scopes[scope] = resolved
+        return resolved
+
+class ResolvedSettings(object):
+    def __init__(self, overrides, override_rule, settings, rule):
+        self.sources = (override_rule, overrides, rule)
+        self.settings = settings
+        self.vals = {}
+
+    def get(self, key):
+        try:
+            return self.vals[key]
+        except KeyError:
+            pass
+
+        for source in self.sources:
+            (val, found) = get(source, key)
+            if found:
+                break
+        else:
+            val = self.settings.get(key)
+
+        validate_setting(key, val)
+        self.vals[key] = val
+        return val
+
+class Rules(object):
+    def __init__(self, rules, score):
+        self.rules = rules or []
+        self.score = score
+        self.scopes = {}
+        self.err = None
+        try:
+            for rule in self.rules:
+                validate_rule(rule)
+        except ErrMsg as err:
+            self.err = err
+
+    def for_scope(self, scope):
+        if self.err is not None:
+            raise self.err
+
+        try:
+            return self.scopes[scope]
+        except KeyError:
+            pass
+
+        rule = rule_for_scope(self.rules, scope, self.score)
+        self.scopes[scope] = rule
+        return rule
+
+def rule_for_scope(rules, scope, score):
+    best_rule = None
+    best_score = 0
+
+    # Like `max`, the first of equally scored rules wins.
+    for rule in rules:
+        rule_score = score(scope, rule['selector'])
+        if rule_score > best_score:
+            best_rule = rule
+            best_score = rule_score
+
+    return best_rule
+
+def validate_rule(rule):
+    if not isinstance(rule, dict):
+        raise ErrMsg('expected rule to be a dict, found {}'.format(rule))
+    if 'selector' not in rule:
+        raise ErrMsg('missing "selector" in rule {}'.format(rule))
+    if not is_string(rule['selector']):
+        raise ErrMsg('expected "selector" to be a string, found {} in rule {}'.format(rule['selector'], rule))
+    validate_setting('cmd', rule.get('cmd'))
+
+def validate_setting(key, val):
+    if key == 'cmd' and val and (not isinstance(val, list) or not every(val, is_string)):
+        raise ErrMsg('expected setting "cmd" to be a list of strings, found {}'.format(val))
+
+def every(iter, fun):
+    if iter:
+        for val in iter:
+            if not fun(val):
+                return False
+    return True
+
+def is_string(val):
+    return isinstance(val, str)
+
+def megabytes(val):
+    return int((val or 0) * 1024 * 1024)
+
+# Variables describing the file at `path`, as in Sublime's
+# `window.extract_variables`.
+def file_variables(path):
+    (base, ext) = os.path.splitext(os.path.basename(path))
+    return {
+        'file': path,
+        'file_path': os.path.dirname(path),
+        'file_name': os.path.basename(path),
+        'file_base_name': base,
+        'file_extension': ext[1:],
+    }
+
+def indent_variables(tab_size, translate_tabs_to_spaces):
+    tab_size = tab_size or 0
+    return {
+        'tab_size': str(tab_size),
+        'indent': ' ' * tab_size if translate_tabs_to_spaces else '\t',
+    }
+
+def score_selector(scope, selector):
+    """Stand-in for `sublime.score_selector`, for running without Sublime.
+
+    Supports alternatives separated by "," or "|", descendants separated by
+    spaces, and exclusions with "-". Doesn't support grouping. Scores are
+    positive for matches, and higher for matches deeper in the scope and for
+    more specific selectors, but differ from Sublime's.
+    """
+    atoms = scope.split()
+    best = 0
+    for alternative in re.split(r'[,|]', selector):
+        (include, *excludes) = re.split(r'(?:^|\s)-\s*', alternative.strip())
+        if any(selector_score(atoms, exclude) for exclude in excludes):
+            continue
+        best = max(best, selector_score(atoms, include) if include.strip() else 1)
+    return best
+
+# Each descendant must match a later atom of the scope than the previous one.
+def selector_score(atoms, selector):
+    score = 0
+    index = 0
+    for part in selector.split():
+        while index < len(atoms) and not (atoms[index] == part or atoms[index].startswith(part + '.')):
+            index += 1
+        if index == len(atoms):
+            return 0
+        score += (index + 1) * 16 + part.count('.') + 1
+        index += 1
+    return score
+
+def expand_variables(val, variables):
+    """Stand-in for `sublime.expand_variables`, for running without Sublime.
+
+    Supports "$name", "${name}", "${name:default}", and "\\$" for a literal
+    "$". Unknown variables expand to nothing.
+    """
+    def expand(match):
+        (escaped, name, braced, default) = match.groups()
+        if escaped:
+            return escaped
+        var = variables.get(name or braced)
+        return (default or '') if var is None else var
+    return VARIABLE.sub(expand, val)
+
+def load_settings(path):
+    """Reads a ".sublime-settings" file, which is JSON with comments and
+    trailing commas."""
+    with open(path, encoding='utf-8') as file:
+        text = file.read()
+    text = SETTINGS_COMMENT.sub(lambda match: match.group(1) or ' ', text)
+    text = SETTINGS_COMMA.sub(lambda match: match.group(1) or '', text)
+    return json.loads(text)
@@ -0,0 +1,197 @@
+"""
+Long-lived formatter processes, used for rules with `"mode": "daemon"`.
+
+A daemon is started once per (cmd, cwd, env) and handles many requests over
+stdin/stdout. The protocol is JSON lines: one JSON object per line, UTF-8.
+
+    request:  {"input": "<source text>", "file": "<path or null>"}
+    response: {"output": "<formatted text>"} or {"error": "<message>"}
+
+Requests are strictly sequential: each request is followed by exactly one
+response line. Anything written to stderr is kept (the tail only) and shown
+when the daemon crashes.
+"""
+
+import collections
+import json
+import queue
+import threading
+from . import launch
+
+STDERR_TAIL_SIZE = 64
+
+class DaemonErr(Exception):
+    pass
+
+class Daemon(object):
+    def __init__(self, cmd, cwd, env, startupinfo=None):
+        self.cmd = cmd
+        self.cwd = cwd
+        self.env = env
+        self.startupinfo = startupinfo
+        self.proc = None
+        self.lines = None
+        self.stderr = collections.deque(maxlen=STDERR_TAIL_SIZE)
+        self.lock = threading.Lock()
+        self.idle_timer = None
+
+    def request(self, input, file=None, timeout=None, idle_timeout=None):
+        with self.lock:
+            self.cancel_idle_timer()
+            try:
+                return self.request_with_restart(input, file, timeout)
+            finally:
+                self.schedule_idle_timer(idle_timeout)
+
+    def request_with_restart(self, input, file, timeout):
+        # A daemon that died between requests, for example after a crash on
+        # the previous input, is restarted once. A daemon that dies during
+        # the retry is reported.
+        restarted = not self.alive()
+        if restarted:
+            self.start()
+
+        try:
+            return self.exchange(input, file, timeout)
+        except BrokenPipeError:
+            if restarted:
+                raise self.crash_err()
+
+        self.stop()
+        self.start()
+        try:
+            return self.exchange(input, file, timeout)
+        except BrokenPipeError:
+            raise self.crash_err()
+
+    def exchange(self, input, file, timeout):
+        frame = json.dumps({'input': input, 'file': file}) + '\n'
+        self.proc.stdin.write(frame.encode('utf-8'))
+        self.proc.stdin.flush()
+
+        try:
+            line = self.lines.get(timeout=timeout)
+        except queue.Empty:
+            # The daemon may still write a response to this request, which
+            # would desync every subsequent request.
+            self.stop()
+            raise DaemonErr('daemon {} timed out after {} seconds'.format(self.cmd, timeout))
+
+        if line is None:
+            raise BrokenPipeError()
+
+        try:
+            msg = json.loads(line.decode('utf-8'))
+        except ValueError:
+            self.stop()
+            raise DaemonErr('daemon {} sent malformed response: {!r}'.format(self.cmd, line))
+
+        if not isinstance(msg, dict):
+            self.stop()
+            raise DaemonErr('daemon {} sent malformed response: {!r}'.format(self.cmd, line))
+
+        if msg.get('error'):
+            raise DaemonErr(msg['error'])
+
+        output = msg.get('output')
+        if not isinstance(output, str):
+            raise DaemonErr('daemon {} sent response without "output": {!r}'.format(self.cmd, line))
+        return output
+
+    def alive(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def start(self):
+        self.stderr.clear()
+        self.lines = queue.Queue()
+
+        try:
+            self.proc = launch.popen(self.cmd, self.cwd, self.env, self.startupinfo)
+        except OSError as err:
+            self.proc = None
+            raise DaemonErr('unable to start daemon {}: {}'.format(self.cmd, err))
+
+        spawn_thread(read_lines, self.proc.stdout, self.lines.put)
+        spawn_thread(read_lines, self.proc.stderr, self.stderr.append)
+
+    def stop(self):
+        proc = self.proc
+        self.proc = None
+        if proc is None:
+            return
+        launch.kill(proc)
+        for pipe in (proc.stdin, proc.stdout, proc.stderr):
+            try:
+                pipe.close()
+            except:
+                pass
+
+    def crash_err(self):
+        msg = 'daemon {} exited unexpectedly'.format(self.cmd)
+        if self.proc is not None and self.proc.poll() is not None:
+            msg += ' with code {}'.format(self.proc.returncode)
+        stderr = b''.join(line for line in self.stderr if line).decode('utf-8', 'replace')
+        self.stop()
+        if stderr:
+            msg += ':\n' + stderr
+        return DaemonErr(msg)
+
+    def schedule_idle_timer(self, idle_timeout):
+        if not idle_timeout:
+            return
+        self.idle_timer = threading.Timer(idle_timeout, self.stop_if_idle)
+        self.idle_timer.daemon = True
+        self.idle_timer.start()
+
+    def cancel_idle_timer(self):
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+            self.idle_timer = None
+
+    def stop_if_idle(self):
+        # Non-blocking: if a request is in progress, the daemon isn't idle.
+        if self.lock.acquire(blocking=False):
+            try:
+                self.stop()
+            finally:
+                self.lock.release()
+
+class Pool(object):
+    def __init__(self):
+        self.daemons = {}
+        self.lock = threading.Lock()
+
+    def get(self, cmd, cwd, env, startupinfo=None):
+        key = daemon_key(cmd, cwd, env)
+        with self.lock:
+            daemon = self.daemons.get(key)
+            if daemon is None:
+                daemon = Daemon(cmd, cwd, env, startupinfo)
+                self.daemons[key] = daemon
+            return daemon
+
+    def stop_all(self):
+        with self.lock:
+            daemons = list(self.daemons.values())
+            self.daemons.clear()
+        for daemon in daemons:
+            daemon.cancel_idle_timer()
+            daemon.stop()
+
+def daemon_key(cmd, cwd, env):
+    return (tuple(cmd), cwd, frozenset(env.items()) if env is not None else None)
+
+# Calls `fun` with every line, and finally with `None` on EOF.
+def read_lines(pipe, fun):
+    try:
+        for line in iter(pipe.readline, b''):
+            fun(line)
+    except (OSError, ValueError):
+        pass
+    fun(None)
+
+def spawn_thread(fun, *args):
+    thread = threading.Thread(target=fun, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
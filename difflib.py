@@ -8,8 +8,13 @@ Originally found at http://code.google.com/p/google-diff-match-patch/.
 Edited by Nelo Mitranim (2017, 2020).
 """
 
+import bisect
+import itertools
 import re
+import time
+from array import array
 from collections import namedtuple
+from . import accel
 
 class Ops(object):
     EQUAL  = 'EQUAL'
@@ -18,6 +23,16 @@ class Ops(object):
 
 Diff = namedtuple('Diff', ['op', 'text'])
 
+# Ops of `Spans`, which are stored as small ints.
+class SpanOps(object):
+    EQUAL  = 0
+    INSERT = 1
+    DELETE = 2
+
+SPAN_OPS = {Ops.EQUAL: SpanOps.EQUAL, Ops.INSERT: SpanOps.INSERT, Ops.DELETE: SpanOps.DELETE}
+
+OP_NAMES = [Ops.EQUAL, Ops.INSERT, Ops.DELETE]
+
 # Cost of an empty edit operation in terms of edit characters.
 DIFF_EDIT_COST = 4
 
@@ -27,10 +42,34 @@ BLANK_LINE_START = re.compile(r"^\r?\n\r?\n")
 
 MAX_DIFFS_THRESHOLD = 32
 
+# Deadline that is never reached. Unlike no deadline at all, it also disables
+# MAX_DIFFS_THRESHOLD.
+NO_DEADLINE = float('inf')
+
+# Block of -1 entries that V arrays are reset from, a slice at a time, so that
+# resetting doesn't need a third array as large as them.
+V_RESET = memoryview(array('l', [-1]) * 4096)
+
 class TooManyDiffsException(Exception):
     pass
 
-def myers_diffs(text1, text2, checklines=True):
+def deadline_after(timeout_ms):
+    """Convert a timeout into a deadline for the diff functions.
+
+    Args:
+        timeout_ms: Milliseconds from now, or None for no deadline.
+
+    Returns:
+        Deadline in terms of `time.perf_counter`, or None.
+    """
+    if timeout_ms is None:
+        return None
+    return time.perf_counter() + timeout_ms / 1000.0
+
+def past_deadline(deadline):
+    return deadline is not None and time.perf_counter() > deadline
+
+def myers_diffs(text1, text2, checklines=True, deadline=None, table=None):
     """Find the differences between two texts.  Simplifies the problem by
         stripping any common prefix or suffix off the texts before diffing.
 
@@ -40,6 +79,12 @@ def myers_diffs(text1, text2, checklines=True):
         checklines: Optional speedup flag.  If present and false, then don't run
             a line-level diff first to identify the changed areas.
             Defaults to true, which does a faster, slightly less optimal diff.
+        deadline: Optional time, in terms of `time.perf_counter`, after which
+            the diff degrades to a coarser but still valid one instead of
+            refining further.  Without a deadline, diffs exceeding
+            MAX_DIFFS_THRESHOLD raise TooManyDiffsException.
+        table: Optional LineTable for the line-level diff, see
+            `lines_to_tokens`.
 
     Returns:
         List of changes.
@@ -69,7 +114,7 @@ def myers_diffs(text1, text2, checklines=True):
         text2 = text2[:-common_length]
 
     # Compute the diff on the middle block.
-    diffs = compute_diffs(text1, text2, checklines)
+    diffs = compute_diffs(text1, text2, checklines, deadline, table)
 
     # Restore the prefix and suffix.
     if common_prefix:
@@ -79,7 +124,7 @@ def myers_diffs(text1, text2, checklines=True):
     cleanup_merge(diffs)
     return diffs
 
-def compute_diffs(text1, text2, checklines):
+def compute_diffs(text1, text2, checklines, deadline=None, table=None):
     """Find the differences between two texts.  Assumes that the texts do not
         have any common prefix or suffix.
 
@@ -89,6 +134,8 @@ def compute_diffs(text1, text2, checklines):
         checklines: Speedup flag.  If false, then don't run a line-level diff
             first to identify the changed areas.
             If true, then run a faster, slightly less optimal diff.
+        deadline: Optional deadline, see `myers_diffs`.
+        table: Optional LineTable, see `myers_diffs`.
 
     Returns:
         List of changes.
@@ -122,30 +169,37 @@ def compute_diffs(text1, text2, checklines):
         return [Diff(Ops.DELETE, text1), Diff(Ops.INSERT, text2)]
 
     if checklines and len(text1) > 100 and len(text2) > 100:
-        return line_mode_diffs(text1, text2)
+        return line_mode_diffs(text1, text2, deadline, table)
 
-    return diff_bisect(text1, text2)
+    return diff_bisect(text1, text2, deadline)
 
-def line_mode_diffs(text1, text2):
+def line_mode_diffs(text1, text2, deadline=None, table=None):
     """Do a quick line-level diff on both strings, then rediff the parts for
         greater accuracy.
         This speedup can produce non-minimal diffs.
+        Past the deadline, the remaining parts are left as line-level hunks.
 
     Args:
         text1: Old string to be diffed.
         text2: New string to be diffed.
+        deadline: Optional deadline, see `myers_diffs`.
+        table: Optional LineTable to reuse, see `lines_to_tokens`.
 
     Returns:
         List of changes.
     """
 
     # Scan the text on a line-by-line basis first.
-    (text1, text2, line_list) = lines_to_chars(text1, text2)
+    (tokens1, offsets1, tokens2, offsets2) = lines_to_tokens(text1, text2, table)
 
-    diffs = myers_diffs(text1, text2, False)
+    spans = bisect_spans(tokens1, tokens2, deadline)
 
     # Convert the diff back to original text.
-    diffs = [diff._replace(text=''.join(line_list[ord(char)] for char in diff.text)) for diff in diffs]
+    diffs = [
+        Diff(OP_NAMES[op], text2[offsets2[start]:offsets2[end]]) if op == SpanOps.INSERT
+        else Diff(OP_NAMES[op], text1[offsets1[start]:offsets1[end]])
+        for (op, start, end) in spans
+    ]
 
     # Eliminate freak matches (e.g. blank lines)
     cleanup_semantic(diffs)
@@ -167,9 +221,9 @@ def line_mode_diffs(text1, text2):
             text_delete += diffs[pointer].text
         elif diffs[pointer].op == Ops.EQUAL:
             # Upon reaching an equality, check for prior redundancies.
-            if count_delete >= 1 and count_insert >= 1:
+            if count_delete >= 1 and count_insert >= 1 and not past_deadline(deadline):
                 # Delete the offending records and add the merged ones.
-                a = myers_diffs(text_delete, text_insert, False)
+                a = myers_diffs(text_delete, text_insert, False, deadline)
                 diffs[pointer - count_delete - count_insert : pointer] = a
                 pointer = pointer - count_delete - count_insert + len(a)
             count_insert = 0
@@ -183,28 +237,145 @@ def line_mode_diffs(text1, text2):
 
     return diffs
 
-def diff_bisect(text1, text2):
+def diff_bisect(text1, text2, deadline=None):
     """Find the 'middle snake' of a diff, split the problem in two
-        and return the recursively constructed diff.
+        and repeat for both halves.
         See Myers 1986 paper: An O(ND) Difference Algorithm and Its Variations.
+        Halves are index ranges of the texts, kept on an explicit stack rather
+        than sliced out and diffed recursively, and all of them share one
+        pair of integer buffers.
 
     Args:
         text1: Old string to be diffed.
         text2: New string to be diffed.
+        deadline: Optional deadline, see `myers_diffs`.  When reached, the
+            remaining halves are treated as entirely different.
 
     Returns:
         List of diff tuples.
     """
+    return bisect_spans(text1, text2, deadline).diffs(text1, text2)
+
+def bisect_spans(text1, text2, deadline=None):
+    """Like `diff_bisect`, but returns offsets into the texts instead of
+    copies of them.  Also works on arrays of tokens, see `lines_to_tokens`.
+
+    Returns:
+        Spans.
+    """
+    # Big enough for the V arrays of the whole problem, and thus of any
+    # part of it.  `middle_snake` resets the entries it uses.
+    size = len(text1) + len(text2) + 2
+    v1 = array('l', [-1]) * size
+    v2 = array('l', [-1]) * size
+    # Views of the texts for `accel`, made on first use.
+    seqs = [] if accel.ENABLED and size >= 2 * accel.MIN_D else None
+
+    is_text = isinstance(text1, str)
+    spans = Spans()
+    split = False
+    # Items are either ranges to diff, or equal ranges to emit; pushed in
+    # reverse order.
+    stack = [(None, 0, len(text1), 0, len(text2))]
+    while stack:
+        (op, lo1, hi1, lo2, hi2) = stack.pop()
+        if op is not None:
+            spans.append(op, lo1, hi1)
+            continue
+
+        # With a deadline, the diff is bounded by time rather than size.
+        if split and deadline is None and len(spans) > MAX_DIFFS_THRESHOLD:
+            raise TooManyDiffsException()
+
+        # Trim off common prefix and suffix.
+        common_length = range_prefix_length(text1, lo1, hi1, text2, lo2, hi2)
+        spans.append(SpanOps.EQUAL, lo1, lo1 + common_length)
+        lo1 += common_length
+        lo2 += common_length
+        common_length = range_suffix_length(text1, lo1, hi1, text2, lo2, hi2)
+        if common_length:
+            stack.append((SpanOps.EQUAL, hi1 - common_length, hi1, None, None))
+            hi1 -= common_length
+            hi2 -= common_length
+
+        if lo1 == hi1:
+            # Just add some text (speedup).
+            spans.append(SpanOps.INSERT, lo2, hi2)
+            continue
+
+        if lo2 == hi2:
+            # Just delete some text (speedup).
+            spans.append(SpanOps.DELETE, lo1, hi1)
+            continue
+
+        # Arrays of tokens have no substring search, and are left to the
+        # bisection.
+        if is_text and hi1 - lo1 > hi2 - lo2:
+            i = text1.find(text2[lo2:hi2], lo1, hi1)
+            if i != -1:
+                # Shorter text is inside the longer text (speedup).
+                spans.append(SpanOps.DELETE, lo1, i)
+                spans.append(SpanOps.EQUAL, i, i + hi2 - lo2)
+                spans.append(SpanOps.DELETE, i + hi2 - lo2, hi1)
+                continue
+        elif is_text:
+            i = text2.find(text1[lo1:hi1], lo2, hi2)
+            if i != -1:
+                # Shorter text is inside the longer text (speedup).
+                spans.append(SpanOps.INSERT, lo2, i)
+                spans.append(SpanOps.EQUAL, lo1, hi1)
+                spans.append(SpanOps.INSERT, i + hi1 - lo1, hi2)
+                continue
+
+        if hi1 - lo1 == 1 or hi2 - lo2 == 1:
+            # Single character string.
+            # After the previous speedup, the character can't be an equality.
+            spans.append(SpanOps.DELETE, lo1, hi1)
+            spans.append(SpanOps.INSERT, lo2, hi2)
+            continue
+
+        snake = middle_snake(text1, lo1, hi1, text2, lo2, hi2, v1, v2, deadline, seqs)
+        if snake is None:
+            # Deadline reached, or no commonality at all.
+            spans.append(SpanOps.DELETE, lo1, hi1)
+            spans.append(SpanOps.INSERT, lo2, hi2)
+            continue
+
+        (x, y) = snake
+        stack.append((None, x, hi1, y, hi2))
+        stack.append((None, lo1, x, lo2, y))
+        split = True
+
+    return spans
+
+def middle_snake(text1, lo1, hi1, text2, lo2, hi2, v1, v2, deadline, seqs=None):
+    """Find the 'middle snake' of a diff of text1[lo1:hi1] and
+    text2[lo2:hi2].
+
+    Args:
+        text1: Old string to be diffed.
+        lo1, hi1: Range of text1.
+        text2: New string to be diffed.
+        lo2, hi2: Range of text2.
+        v1, v2: Integer arrays of at least the combined length of the ranges
+            plus two, filled with -1.  Left filled with -1.
+        deadline: Optional deadline, see `myers_diffs`.
+        seqs: Optional list, for handing wide fronts over to `accel`.  Filled
+            with `accel.sequences` of the texts on first use.
+
+    Returns:
+        Tuple of the split point in text1 and text2, or None when there's no
+        commonality at all or the deadline is reached.
+    """
 
     # Cache the text lengths to prevent multiple calls.
-    text1_length = len(text1)
-    text2_length = len(text2)
+    text1_length = hi1 - lo1
+    text2_length = hi2 - lo2
     max_d = (text1_length + text2_length + 1) // 2
     v_offset = max_d
     v_length = 2 * max_d
-    v1 = [-1] * v_length
     v1[v_offset + 1] = 0
-    v2 = v1[:]
+    v2[v_offset + 1] = 0
     delta = text1_length - text2_length
     # If the total number of characters is odd, then the front path will
     # collide with the reverse path.
@@ -215,152 +386,424 @@ def diff_bisect(text1, text2):
     k1end = 0
     k2start = 0
     k2end = 0
-    for d in range(max_d):
-        # Walk the front path one step.
-        for k1 in range(-d + k1start, d + 1 - k1end, 2):
-            k1_offset = v_offset + k1
-            if k1 == -d or (k1 != d and
-                    v1[k1_offset - 1] < v1[k1_offset + 1]):
-                x1 = v1[k1_offset + 1]
-            else:
-                x1 = v1[k1_offset - 1] + 1
-            y1 = x1 - k1
-            while (x1 < text1_length and y1 < text2_length and
-                         text1[x1] == text2[y1]):
-                x1 += 1
-                y1 += 1
-            v1[k1_offset] = x1
-            if x1 > text1_length:
-                # Ran off the right of the graph.
-                k1end += 2
-            elif y1 > text2_length:
-                # Ran off the bottom of the graph.
-                k1start += 2
-            elif front:
-                k2_offset = v_offset + delta - k1
-                if k2_offset >= 0 and k2_offset < v_length and v2[k2_offset] != -1:
-                    # Mirror x2 onto top-left coordinate system.
-                    x2 = text1_length - v2[k2_offset]
-                    if x1 >= x2:
-                        # Overlap detected.
-                        return bisect_split_diffs(text1, text2, x1, y1)
-
-        # Walk the reverse path one step.
-        for k2 in range(-d + k2start, d + 1 - k2end, 2):
-            k2_offset = v_offset + k2
-            if k2 == -d or (k2 != d and
-                    v2[k2_offset - 1] < v2[k2_offset + 1]):
-                x2 = v2[k2_offset + 1]
-            else:
-                x2 = v2[k2_offset - 1] + 1
-            y2 = x2 - k2
-            while (x2 < text1_length and y2 < text2_length and
-                         text1[-x2 - 1] == text2[-y2 - 1]):
-                x2 += 1
-                y2 += 1
-            v2[k2_offset] = x2
-            if x2 > text1_length:
-                # Ran off the left of the graph.
-                k2end += 2
-            elif y2 > text2_length:
-                # Ran off the top of the graph.
-                k2start += 2
-            elif not front:
-                k1_offset = v_offset + delta - k2
-                if k1_offset >= 0 and k1_offset < v_length and v1[k1_offset] != -1:
-                    x1 = v1[k1_offset]
-                    y1 = v_offset + x1 - k1_offset
-                    # Mirror x2 onto top-left coordinate system.
-                    x2 = text1_length - x2
-                    if x1 >= x2:
-                        # Overlap detected.
-                        return bisect_split_diffs(text1, text2, x1, y1)
-
-    # Number of diffs equals number of characters, no commonality at all.
-    return [Diff(Ops.DELETE, text1), Diff(Ops.INSERT, text2)]
-
-def bisect_split_diffs(text1, text2, x, y):
-    """Given the location of the 'middle snake', split the diff in two parts
-    and recurse.
+    d = 0
+    try:
+        for d in range(max_d):
+            # Bail out if deadline is reached.
+            if past_deadline(deadline):
+                break
+
+            # Wide fronts are faster to walk with array operations.
+            if d == accel.MIN_D and seqs is not None:
+                if not seqs:
+                    seqs.extend(accel.sequences(text1, text2))
+                return accel.middle_snake(
+                    seqs, lo1, hi1, lo2, hi2, v1, v2, deadline,
+                    d, k1start, k1end, k2start, k2end,
+                )
+
+            # Walk the front path one step.
+            for k1 in range(-d + k1start, d + 1 - k1end, 2):
+                k1_offset = v_offset + k1
+                if k1 == -d or (k1 != d and
+                        v1[k1_offset - 1] < v1[k1_offset + 1]):
+                    x1 = v1[k1_offset + 1]
+                else:
+                    x1 = v1[k1_offset - 1] + 1
+                y1 = x1 - k1
+                while (x1 < text1_length and y1 < text2_length and
+                             text1[lo1 + x1] == text2[lo2 + y1]):
+                    x1 += 1
+                    y1 += 1
+                v1[k1_offset] = x1
+                if x1 > text1_length:
+                    # Ran off the right of the graph.
+                    k1end += 2
+                elif y1 > text2_length:
+                    # Ran off the bottom of the graph.
+                    k1start += 2
+                elif front:
+                    k2_offset = v_offset + delta - k1
+                    if k2_offset >= 0 and k2_offset < v_length and v2[k2_offset] != -1:
+                        # Mirror x2 onto top-left coordinate system.
+                        x2 = text1_length - v2[k2_offset]
+                        if x1 >= x2:
+                            # Overlap detected.
+                            return (lo1 + x1, lo2 + y1)
+
+            # Walk the reverse path one step.
+            for k2 in range(-d + k2start, d + 1 - k2end, 2):
+                k2_offset = v_offset + k2
+                if k2 == -d or (k2 != d and
+                        v2[k2_offset - 1] < v2[k2_offset + 1]):
+                    x2 = v2[k2_offset + 1]
+                else:
+                    x2 = v2[k2_offset - 1] + 1
+                y2 = x2 - k2
+                while (x2 < text1_length and y2 < text2_length and
+                             text1[hi1 - x2 - 1] == text2[hi2 - y2 - 1]):
+                    x2 += 1
+                    y2 += 1
+                v2[k2_offset] = x2
+                if x2 > text1_length:
+                    # Ran off the left of the graph.
+                    k2end += 2
+                elif y2 > text2_length:
+                    # Ran off the top of the graph.
+                    k2start += 2
+                elif not front:
+                    k1_offset = v_offset + delta - k2
+                    if k1_offset >= 0 and k1_offset < v_length and v1[k1_offset] != -1:
+                        x1 = v1[k1_offset]
+                        y1 = v_offset + x1 - k1_offset
+                        # Mirror x2 onto top-left coordinate system.
+                        x2 = text1_length - x2
+                        if x1 >= x2:
+                            # Overlap detected.
+                            return (lo1 + x1, lo2 + y1)
+
+        # Deadline reached, or number of diffs equals number of characters, no
+        # commonality at all.
+        return None
+    finally:
+        # Only entries within d of v_offset, and the initial one, were written.
+        start = max(0, v_offset - d)
+        end = v_offset + d + 2
+        reset_v(v1, start, end)
+        reset_v(v2, start, end)
+
+def reset_v(v, start, end):
+    """Fill v[start:end] with -1."""
+    view = memoryview(v)
+    end = min(end, len(v))
+    while start < end:
+        size = min(end - start, len(V_RESET))
+        view[start:start + size] = V_RESET[:size]
+        start += size
+
+def line_diffs(text1, text2, deadline=None, anchors=None, table=None):
+    """Find the differences between two texts at line granularity.  An anchor
+    strategy finds runs of equal lines in the changed area, and the gaps
+    between them are diffed the same way.  The default strategy is patience:
+    lines that occur exactly once in both texts are matched up via a longest
+    increasing subsequence.  Gaps without anchors fall back on Myers over
+    whole lines.  Typically close to O(N log N), and the result consists of
+    whole lines only.
 
     Args:
         text1: Old string to be diffed.
         text2: New string to be diffed.
-        x: Index of split point in text1.
-        y: Index of split point in text2.
+        deadline: Optional deadline, see `myers_diffs`.  Past the deadline,
+            remaining gaps are treated as entirely different.
+        anchors: Optional anchor strategy, such as `patience_anchors` or
+            `histogram_anchors`.
+        table: Optional LineTable to reuse, see `lines_to_tokens`.
 
     Returns:
-        List of diff tuples.
+        List of changes.
     """
-    text1a = text1[:x]
-    text2a = text2[:y]
-    text1b = text1[x:]
-    text2b = text2[y:]
+    return line_spans(text1, text2, deadline, anchors, table).diffs(text1, text2)
 
-    # Compute both diffs serially.
-    diffs = myers_diffs(text1a, text2a, False)
-    diffsb = myers_diffs(text1b, text2b, False)
+def line_spans(text1, text2, deadline=None, anchors=None, table=None):
+    """Like `line_diffs`, but returns offsets into the texts instead of
+    copies of them.
 
-    if len(diffs) + len(diffsb) > MAX_DIFFS_THRESHOLD:
-        raise TooManyDiffsException()
+    Args:
+        table: Optional LineTable to reuse, see `lines_to_tokens`.
 
-    return diffs + diffsb
+    Returns:
+        Spans.
+    """
+    if anchors is None:
+        anchors = patience_anchors
+
+    # Lines common to the start and end of both texts aren't tokenized.
+    (prefix, suffix) = common_line_lengths(text1, text2)
+    (seq1, offsets1, seq2, offsets2) = lines_to_tokens(text1, text2, table, prefix, suffix)
+
+    spans = Spans()
+    spans.append(SpanOps.EQUAL, 0, prefix)
+
+    def emit(op, start, end):
+        offsets = offsets2 if op == SpanOps.INSERT else offsets1
+        spans.append(op, offsets[start], offsets[end])
+
+    # Explicit stack instead of recursion.  Items are either gaps to diff, or
+    # runs of equal lines to emit; pushed in reverse order.
+    stack = [(None, 0, len(seq1), 0, len(seq2))]
+    while stack:
+        (op, lo1, hi1, lo2, hi2) = stack.pop()
+        if op is not None:
+            emit(op, lo1, hi1)
+            continue
+
+        # Common prefix.
+        start1 = lo1
+        while lo1 < hi1 and lo2 < hi2 and seq1[lo1] == seq2[lo2]:
+            lo1 += 1
+            lo2 += 1
+        emit(SpanOps.EQUAL, start1, lo1)
+
+        # Common suffix.
+        end1 = hi1
+        while lo1 < hi1 and lo2 < hi2 and seq1[hi1 - 1] == seq2[hi2 - 1]:
+            hi1 -= 1
+            hi2 -= 1
+        if hi1 < end1:
+            stack.append((SpanOps.EQUAL, hi1, end1, None, None))
+
+        if lo1 == hi1 or lo2 == hi2 or past_deadline(deadline):
+            emit(SpanOps.DELETE, lo1, hi1)
+            emit(SpanOps.INSERT, lo2, hi2)
+            continue
+
+        runs = anchors(seq1, lo1, hi1, seq2, lo2, hi2)
+        if not runs:
+            for (op, start, end) in myers_line_ops(seq1, lo1, hi1, seq2, lo2, hi2, deadline):
+                emit(op, start, end)
+            continue
+
+        # Gaps between anchors, and the anchors themselves, in reverse.
+        (next1, next2) = (hi1, hi2)
+        for (pos1, pos2, length) in reversed(runs):
+            stack.append((None, pos1 + length, next1, pos2 + length, next2))
+            stack.append((SpanOps.EQUAL, pos1, pos1 + length, None, None))
+            (next1, next2) = (pos1, pos2)
+        stack.append((None, lo1, next1, lo2, next2))
+
+    spans.append(SpanOps.EQUAL, len(text1) - suffix, len(text1))
+    return spans
+
+def patience_anchors(seq1, lo1, hi1, seq2, lo2, hi2):
+    """Anchor strategy for `line_diffs`.  Find lines that occur exactly once
+    in both ranges, and pick the longest subset that appears in the same order
+    in both.
 
-def lines_to_chars(text1, text2):
-    """Split two texts into a list of strings.  Reduce the texts to a string
-    of dicts where each Unicode character represents one line.
+    Args:
+        seq1: Line ids of the old text.
+        lo1, hi1: Range in seq1.
+        seq2: Line ids of the new text.
+        lo2, hi2: Range in seq2.
+
+    Returns:
+        List of (index in seq1, index in seq2, length) in increasing order.
+    """
+    counts = {}
+    for i in range(lo1, hi1):
+        entry = counts.get(seq1[i])
+        counts[seq1[i]] = [1, i, -1] if entry is None else [entry[0] + 1, i, -1]
+    for j in range(lo2, hi2):
+        entry = counts.get(seq2[j])
+        if entry is not None and entry[0] == 1:
+            # Second occurrence in seq2 disqualifies the line.
+            entry[2] = j if entry[2] == -1 else -2
+
+    pairs = [(i, j) for (_, i, j) in counts.values() if j >= 0]
+    if not pairs:
+        return []
+    pairs.sort()
+
+    # Patience sorting: longest increasing subsequence of positions in seq2.
+    tails = []  # tails[k] = index in pairs of the smallest tail of length k+1
+    tail_vals = []
+    prev = [-1] * len(pairs)
+    for (index, (_, j)) in enumerate(pairs):
+        k = bisect.bisect_left(tail_vals, j)
+        if k > 0:
+            prev[index] = tails[k - 1]
+        if k == len(tails):
+            tails.append(index)
+            tail_vals.append(j)
+        else:
+            tails[k] = index
+            tail_vals[k] = j
+
+    out = []
+    index = tails[-1]
+    while index != -1:
+        (i, j) = pairs[index]
+        out.append((i, j, 1))
+        index = prev[index]
+    out.reverse()
+    return out
+
+# Lines occurring more often than this are not considered as histogram
+# anchors, which bounds the cost of the search.
+HISTOGRAM_MAX_CHAIN = 64
+
+def histogram_anchors(seq1, lo1, hi1, seq2, lo2, hi2):
+    """Anchor strategy for `line_diffs`, as in Git's histogram diff.  Find the
+    longest run of equal lines that contains the least frequent line of the
+    old range.  Unlike patience, works when no line is unique.
 
     Args:
-        text1: First string.
-        text2: Second string.
+        seq1: Line ids of the old text.
+        lo1, hi1: Range in seq1.
+        seq2: Line ids of the new text.
+        lo2, hi2: Range in seq2.
 
     Returns:
-        Three element tuple, containing the encoded text1, the encoded text2 and
-        the list of unique strings.  The zeroth element of the list of unique
-        strings is intentionally blank.
+        List with at most one (index in seq1, index in seq2, length).
     """
-    line_list = []   # e.g. line_list[4] == "Hello\n"
-    line_dict = {}   # e.g. line_dict["Hello\n"] == 4
+    positions = {}
+    for i in range(lo1, hi1):
+        positions.setdefault(seq1[i], []).append(i)
+
+    best = None
+    best_count = HISTOGRAM_MAX_CHAIN + 1
+    best_length = 0
+    j = lo2
+    while j < hi2:
+        occurrences = positions.get(seq2[j])
+        if occurrences is None or len(occurrences) > best_count:
+            j += 1
+            continue
+
+        next_j = j + 1
+        for i in occurrences:
+            # Extend the match in both directions.
+            (start1, start2) = (i, j)
+            while start1 > lo1 and start2 > lo2 and seq1[start1 - 1] == seq2[start2 - 1]:
+                start1 -= 1
+                start2 -= 1
+            (end1, end2) = (i + 1, j + 1)
+            while end1 < hi1 and end2 < hi2 and seq1[end1] == seq2[end2]:
+                end1 += 1
+                end2 += 1
+
+            # Lower occurrence count wins; for equal counts, the longer run.
+            count = len(occurrences)
+            length = end1 - start1
+            if count < best_count or length > best_length:
+                best = (start1, start2, length)
+                best_count = count
+                best_length = length
+            next_j = max(next_j, end2)
+        j = next_j
+
+    return [best] if best is not None else []
+
+def no_anchors(seq1, lo1, hi1, seq2, lo2, hi2):
+    """Anchor strategy for `line_diffs` that makes it a plain Myers diff over
+    whole lines."""
+    return []
+
+def myers_line_ops(seq1, lo1, hi1, seq2, lo2, hi2, deadline):
+    """Myers diff over ranges of line tokens, for gaps without unique lines.
 
-    # "\x00" is a valid character, but various debuggers don't like it.
-    # So we'll insert a junk entry to avoid generating a null character.
-    line_list.append('')
+    Returns:
+        List of (op, start, end) with ops of `SpanOps`, where start and end
+        index seq2 for insertions and seq1 otherwise.
+    """
+    spans = bisect_spans(seq1[lo1:hi1], seq2[lo2:hi2], NO_DEADLINE if deadline is None else deadline)
+    return [
+        (op, start + lo2, end + lo2) if op == SpanOps.INSERT else (op, start + lo1, end + lo1)
+        for (op, start, end) in spans
+    ]
+
+class LineTable(object):
+    """Interns lines as integer tokens, for diffing texts line by line.
+    Unlike encoding lines as characters, there's no limit on the number of
+    distinct lines.  Not thread-safe.
+    """
+    __slots__ = ('ids',)
 
-    def lines_to_chars_munge(text):
-        """Split a text into a list of strings.  Reduce the texts to a string
-        of dicts where each Unicode character represents one line.
-        Modifies line_list and lineHash through being a closure.
+    def __init__(self):
+        self.ids = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def prepare(self, text1, text2):
+        """Clear the table when it has grown well beyond what the given texts
+        need, so that a table reused across edits of a document doesn't keep
+        every line it has ever seen.
 
         Args:
-            text: String to encode.
+            text1: First string about to be diffed.
+            text2: Second string about to be diffed.
+        """
+        if len(self.ids) > 2 * (text1.count('\n') + text2.count('\n') + 2):
+            self.ids = {}
+
+    def tokens(self, text, start=0, end=None):
+        """Tokenize the lines of text[start:end], which must start at a line
+        boundary.  Unlike `str.splitlines`, only "\\n" counts as a line
+        ending.  Splits the text in one go, which is much faster than
+        finding lines one by one.
+
+        Args:
+            text: String to tokenize.
+            start, end: Optional range of the text.
 
         Returns:
-            Encoded string.
+            Tuple of two arrays: the token of each line, and the offset in
+            text at which each line starts followed by the end of the range.
         """
-        chars = []
-        # Walk the text, pulling out a substring for each line.
-        # text.split('\n') would would temporarily double our memory footprint.
-        # Modifying text would create many large strings to garbage collect.
-        line_start = 0
-        line_end = -1
-        while line_end < len(text) - 1:
-            line_end = text.find('\n', line_start)
-            if line_end == -1:
-                line_end = len(text) - 1
-            line = text[line_start:line_end + 1]
-            line_start = line_end + 1
-
-            if line in line_dict:
-                chars.append(chr(line_dict[line]))
-            else:
-                line_list.append(line)
-                line_dict[line] = len(line_list) - 1
-                chars.append(chr(len(line_list) - 1))
-        return ''.join(chars)
+        if end is None:
+            end = len(text)
+        ids = self.ids
+        lines = text[start:end].split('\n')
+        # Not followed by "\n", and thus not the same line as an equal one
+        # that is.  Interned under a distinct key.
+        last = lines.pop()
+        tokens = array('l', [ids.setdefault(line, len(ids)) for line in lines])
+        offsets = array('q', itertools.accumulate(map((1).__add__, map(len, lines)), initial=start))
+        if last:
+            tokens.append(ids.setdefault((last,), len(ids)))
+            offsets.append(end)
+        return (tokens, offsets)
+
+def lines_to_tokens(text1, text2, table=None, prefix=0, suffix=0):
+    """Reduce two texts to arrays of tokens, where each token represents one
+    line.
+
+    Args:
+        text1: First string.
+        text2: Second string.
+        table: Optional LineTable to reuse, such as one kept per document.
+            Otherwise, a new table is used.
+        prefix, suffix: Optional number of characters to leave out at the
+            start and end of both texts, such as from `common_line_lengths`.
+
+    Returns:
+        Four element tuple, containing the tokens and line offsets of text1,
+        and the tokens and line offsets of text2.  See `LineTable.tokens`.
+    """
+    if table is None:
+        table = LineTable()
+    else:
+        table.prepare(text1, text2)
+    return (
+        table.tokens(text1, prefix, len(text1) - suffix) +
+        table.tokens(text2, prefix, len(text2) - suffix)
+    )
+
+def common_line_lengths(text1, text2):
+    """Determine the common prefix and suffix of two strings, in whole lines.
+
+    Args:
+        text1: First string.
+        text2: Second string.
 
-    chars1 = lines_to_chars_munge(text1)
-    chars2 = lines_to_chars_munge(text2)
-    return (chars1, chars2, line_list)
+    Returns:
+        Tuple of the number of characters in the lines common to the start
+        of each string, and in those common to the end of each string.
+    """
+    prefix = common_prefix_length(text1, text2)
+    prefix = text1.rfind('\n', 0, prefix) + 1
+    suffix = range_suffix_length(text1, prefix, len(text1), text2, prefix, len(text2))
+    start1 = len(text1) - suffix
+    start2 = len(text2) - suffix
+    if suffix and not (
+        (start1 == 0 or text1[start1 - 1] == '\n') and
+        (start2 == 0 or text2[start2 - 1] == '\n')
+    ):
+        # The rest of the suffix is the same in both strings, and so are
+        # the line boundaries in it.
+        start1 = text1.find('\n', start1) + 1 or len(text1)
+        suffix = len(text1) - start1
+    return (prefix, suffix)
 
 def common_prefix_length(text1, text2):
     """Determine the common prefix of two strings.
@@ -372,23 +815,47 @@ def common_prefix_length(text1, text2):
     Returns:
         The number of characters common to the start of each string.
     """
+    return range_prefix_length(text1, 0, len(text1), text2, 0, len(text2))
+
+def range_prefix_length(text1, lo1, hi1, text2, lo2, hi2):
+    """Determine the common prefix of text1[lo1:hi1] and text2[lo2:hi2],
+    which are strings or arrays of tokens.  Compares blocks of doubling size,
+    then bisects the first block that differs, so the text copied is
+    proportional to the prefix rather than to the strings.
+
+    Returns:
+        The number of characters common to the start of each range.
+    """
+    size = min(hi1 - lo1, hi2 - lo2)
     # Quick check for common null cases.
-    if not text1 or not text2 or text1[0] != text2[0]:
+    if size <= 0 or text1[lo1] != text2[lo2]:
         return 0
-    # Binary search.
-    # Performance analysis: http://neil.fraser.name/news/2007/10/09/
-    pointermin = 0
-    pointermax = min(len(text1), len(text2))
-    pointermid = pointermax
-    pointerstart = 0
-    while pointermin < pointermid:
-        if text1[pointerstart:pointermid] == text2[pointerstart:pointermid]:
+
+    if isinstance(text1, str):
+        def equal(start, end):
+            return text1.startswith(text2[lo2 + start:lo2 + end], lo1 + start, hi1)
+    else:
+        def equal(start, end):
+            return text1[lo1 + start:lo1 + end] == text2[lo2 + start:lo2 + end]
+
+    # Gallop to a block that differs.
+    (length, step) = (1, 1)
+    while True:
+        if length == size:
+            return size
+        step = min(step * 2, size - length)
+        if not equal(length, length + step):
+            break
+        length += step
+    # Binary search within it.
+    (pointermin, pointermax) = (length, length + step)
+    while pointermax - pointermin > 1:
+        pointermid = (pointermin + pointermax) // 2
+        if equal(pointermin, pointermid):
             pointermin = pointermid
-            pointerstart = pointermin
         else:
             pointermax = pointermid
-        pointermid = (pointermax - pointermin) // 2 + pointermin
-    return pointermid
+    return pointermin
 
 def common_suffix_length(text1, text2):
     """Determine the common suffix of two strings.
@@ -400,24 +867,46 @@ def common_suffix_length(text1, text2):
     Returns:
         The number of characters common to the end of each string.
     """
+    return range_suffix_length(text1, 0, len(text1), text2, 0, len(text2))
+
+def range_suffix_length(text1, lo1, hi1, text2, lo2, hi2):
+    """Determine the common suffix of text1[lo1:hi1] and text2[lo2:hi2], like
+    `range_prefix_length`.
+
+    Returns:
+        The number of characters common to the end of each range.
+    """
+    size = min(hi1 - lo1, hi2 - lo2)
     # Quick check for common null cases.
-    if not text1 or not text2 or text1[-1] != text2[-1]:
+    if size <= 0 or text1[hi1 - 1] != text2[hi2 - 1]:
         return 0
-    # Binary search.
-    # Performance analysis: http://neil.fraser.name/news/2007/10/09/
-    pointermin = 0
-    pointermax = min(len(text1), len(text2))
-    pointermid = pointermax
-    pointerend = 0
-    while pointermin < pointermid:
-        if (text1[-pointermid:len(text1) - pointerend] ==
-                text2[-pointermid:len(text2) - pointerend]):
+
+    # Whether the ranges are equal from `start` to `end` counting from the end.
+    if isinstance(text1, str):
+        def equal(start, end):
+            return text1.endswith(text2[hi2 - end:hi2 - start], lo1, hi1 - start)
+    else:
+        def equal(start, end):
+            return text1[hi1 - end:hi1 - start] == text2[hi2 - end:hi2 - start]
+
+    # Gallop to a block that differs.
+    (length, step) = (1, 1)
+    while True:
+        if length == size:
+            return size
+        step = min(step * 2, size - length)
+        if not equal(length, length + step):
+            break
+        length += step
+    # Binary search within it.
+    (pointermin, pointermax) = (length, length + step)
+    while pointermax - pointermin > 1:
+        pointermid = (pointermin + pointermax) // 2
+        if equal(pointermin, pointermid):
             pointermin = pointermid
-            pointerend = pointermin
         else:
             pointermax = pointermid
-        pointermid = (pointermax - pointermin) // 2 + pointermin
-    return pointermid
+    return pointermin
 
 def common_overlap(text1, text2):
     """Determine if the suffix of one string is the prefix of another.
@@ -468,49 +957,48 @@ def cleanup_semantic(diffs):
     Args:
         diffs: List of diff tuples.
     """
-    changes = False
-    equalities = []  # Stack of indices where equalities are found.
-    lastequality = None  # Always equal to diffs[equalities[-1]].text
-    pointer = 0  # Index of current position.
-    # Number of chars that changed prior to the equality.
-    (length_insertions1, length_deletions1) = (0, 0)
-    # Number of chars that changed after the equality.
+    # Stack of equalities that may still be eliminated, as tuples of index
+    # and the number of chars that changed prior to the equality.
+    equalities = []
+    # Number of chars that changed after the last equality.
     (length_insertions2, length_deletions2) = (0, 0)
-    while pointer < len(diffs):
-        if diffs[pointer].op == Ops.EQUAL:  # Equality found.
-            equalities.append(pointer)
-            (length_insertions1, length_insertions2) = (length_insertions2, 0)
-            (length_deletions1, length_deletions2) = (length_deletions2, 0)
-            lastequality = diffs[pointer].text
-        else:  # An insertion or deletion.
-            if diffs[pointer].op == Ops.INSERT:
-                length_insertions2 += len(diffs[pointer].text)
+    eliminated = set()
+    for (index, diff) in enumerate(diffs):
+        if diff.op == Ops.EQUAL:  # Equality found.
+            equalities.append((index, length_insertions2, length_deletions2))
+            (length_insertions2, length_deletions2) = (0, 0)
+            continue
+
+        # An insertion or deletion.
+        if diff.op == Ops.INSERT:
+            length_insertions2 += len(diff.text)
+        else:
+            length_deletions2 += len(diff.text)
+        # Eliminate an equality that is smaller or equal to the edits on both
+        # sides of it.  The edits around it then merge, which may eliminate the
+        # previous equality too.
+        while equalities:
+            (eq_index, length_insertions1, length_deletions1) = equalities[-1]
+            length = len(diffs[eq_index].text)
+            if not (length and (length <= max(length_insertions1, length_deletions1)) and
+                    (length <= max(length_insertions2, length_deletions2))):
+                break
+            equalities.pop()
+            eliminated.add(eq_index)
+            length_insertions2 += length_insertions1 + length
+            length_deletions2 += length_deletions1 + length
+
+    changes = bool(eliminated)
+    if changes:
+        done = []
+        for (index, diff) in enumerate(diffs):
+            if index in eliminated:
+                # Duplicate record, and change second copy to insert.
+                done.append(Diff(Ops.DELETE, diff.text))
+                done.append(diff._replace(op=Ops.INSERT))
             else:
-                length_deletions2 += len(diffs[pointer].text)
-            # Eliminate an equality that is smaller or equal to the edits on both
-            # sides of it.
-            if (lastequality and (len(lastequality) <=
-                    max(length_insertions1, length_deletions1)) and
-                    (len(lastequality) <= max(length_insertions2, length_deletions2))):
-                # Duplicate record.
-                diffs.insert(equalities[-1], Diff(Ops.DELETE, lastequality))
-                # Change second copy to insert.
-                diffs[equalities[-1] + 1] = diffs[equalities[-1] + 1]._replace(op=Ops.INSERT)
-                # Throw away the equality we just deleted.
-                equalities.pop()
-                # Throw away the previous equality (it needs to be reevaluated).
-                if len(equalities):
-                    equalities.pop()
-                if len(equalities):
-                    pointer = equalities[-1]
-                else:
-                    pointer = -1
-                # Reset the counters.
-                length_insertions1, length_deletions1 = 0, 0
-                length_insertions2, length_deletions2 = 0, 0
-                lastequality = None
-                changes = True
-        pointer += 1
+                done.append(diff)
+        diffs[:] = done
 
     # Normalize the diff.
     if changes:
@@ -523,33 +1011,36 @@ def cleanup_semantic(diffs):
     # e.g: <del>xxxabc</del><ins>defxxx</ins>
     #   -> <ins>def</ins>xxx<del>abc</del>
     # Only extract an overlap if it is as big as the edit ahead or behind it.
-    pointer = 1
-    while pointer < len(diffs):
-        if (diffs[pointer - 1].op == Ops.DELETE and
-                diffs[pointer].op == Ops.INSERT):
-            deletion = diffs[pointer - 1].text
-            insertion = diffs[pointer].text
+    # The diff following a checked pair is never the second half of a pair.
+    done = []
+    skip = True
+    for diff in diffs:
+        if not skip and done[-1].op == Ops.DELETE and diff.op == Ops.INSERT:
+            deletion = done[-1].text
+            insertion = diff.text
             overlap_length1 = common_overlap(deletion, insertion)
             overlap_length2 = common_overlap(insertion, deletion)
             if overlap_length1 >= overlap_length2:
                 if (overlap_length1 >= len(deletion) / 2.0 or
                         overlap_length1 >= len(insertion) / 2.0):
                     # Overlap found.  Insert an equality and trim the surrounding edits.
-                    diffs.insert(pointer, Diff(Ops.EQUAL, insertion[:overlap_length1]))
-                    diffs[pointer - 1] = Diff(Ops.DELETE, deletion[:len(deletion) - overlap_length1])
-                    diffs[pointer + 1] = Diff(Ops.INSERT, insertion[overlap_length1:])
-                    pointer += 1
+                    done[-1] = Diff(Ops.DELETE, deletion[:len(deletion) - overlap_length1])
+                    done.append(Diff(Ops.EQUAL, insertion[:overlap_length1]))
+                    diff = Diff(Ops.INSERT, insertion[overlap_length1:])
             else:
                 if (overlap_length2 >= len(deletion) / 2.0 or
                         overlap_length2 >= len(insertion) / 2.0):
                     # Reverse overlap found.
                     # Insert an equality and swap and trim the surrounding edits.
-                    diffs.insert(pointer, Diff(Ops.EQUAL, deletion[:overlap_length2]))
-                    diffs[pointer - 1] = Diff(Ops.INSERT, insertion[:len(insertion) - overlap_length2])
-                    diffs[pointer + 1] = Diff(Ops.DELETE, deletion[overlap_length2:])
-                    pointer += 1
-            pointer += 1
-        pointer += 1
+                    done[-1] = Diff(Ops.INSERT, insertion[:len(insertion) - overlap_length2])
+                    done.append(Diff(Ops.EQUAL, deletion[:overlap_length2]))
+                    diff = Diff(Ops.DELETE, deletion[overlap_length2:])
+            done.append(diff)
+            skip = True
+            continue
+        done.append(diff)
+        skip = False
+    diffs[:] = done
 
 def cleanup_semantic_lossless(diffs):
     """Look for single edits surrounded on both sides by equalities
@@ -610,15 +1101,16 @@ def cleanup_semantic_lossless(diffs):
             return 1
         return 0
 
-    pointer = 1
+    # Diffs before the current one, and from the current one on in reverse.
     # Intentionally ignore the first and last element (don't need checking).
-    while pointer < len(diffs) - 1:
-        if (diffs[pointer - 1].op == Ops.EQUAL and
-                diffs[pointer + 1].op == Ops.EQUAL):
+    done = diffs[:1]
+    todo = diffs[:0:-1]
+    while len(todo) > 1:
+        if (done[-1].op == Ops.EQUAL and todo[-2].op == Ops.EQUAL):
             # This is a single edit surrounded by equalities.
-            equality1 = diffs[pointer - 1].text
-            edit = diffs[pointer].text
-            equality2 = diffs[pointer + 1].text
+            equality1 = done[-1].text
+            edit = todo[-1].text
+            equality2 = todo[-2].text
 
             # First, shift the edit as far left as possible.
             common_offset = common_suffix_length(equality1, edit)
@@ -645,20 +1137,22 @@ def cleanup_semantic_lossless(diffs):
                     best_edit = edit
                     best_equality_2 = equality2
 
-            if diffs[pointer - 1].text != best_equality_1:
+            if done[-1].text != best_equality_1:
                 # We have an improvement, save it back to the diff.
                 if best_equality_1:
-                    diffs[pointer - 1] = diffs[pointer - 1]._replace(text=best_equality_1)
+                    done[-1] = done[-1]._replace(text=best_equality_1)
                 else:
-                    del diffs[pointer - 1]
-                    pointer -= 1
-                diffs[pointer] = diffs[pointer]._replace(text=best_edit)
+                    done.pop()
+                todo[-1] = todo[-1]._replace(text=best_edit)
                 if best_equality_2:
-                    diffs[pointer + 1] = diffs[pointer + 1]._replace(text=best_equality_2)
+                    todo[-2] = todo[-2]._replace(text=best_equality_2)
                 else:
-                    del diffs[pointer + 1]
-                    pointer -= 1
-        pointer += 1
+                    del todo[-2]
+                    # Check the edit again, against the diff after it.
+                    continue
+        done.append(todo.pop())
+    done.extend(reversed(todo))
+    diffs[:] = done
 
 def cleanup_efficiency(diffs):
     """Reduce the number of edits by eliminating operationally trivial
@@ -668,22 +1162,26 @@ def cleanup_efficiency(diffs):
         diffs: List of diff tuples.
     """
     changes = False
-    equalities = []  # Stack of indices where equalities are found.
-    lastequality = None  # Always equal to diffs[equalities[-1]].text
-    pointer = 0  # Index of current position.
+    equalities = []  # Stack of indices into `done` where equalities are found.
+    lastequality = None  # Always equal to done[equalities[-1]].text
     pre_ins = False  # Is there an insertion operation before the last equality.
     pre_del = False  # Is there a deletion operation before the last equality.
     post_ins = False  # Is there an insertion operation after the last equality.
     post_del = False  # Is there a deletion operation after the last equality.
-    while pointer < len(diffs):
-        if diffs[pointer].op == Ops.EQUAL:  # Equality found.
-            if (len(diffs[pointer].text) < DIFF_EDIT_COST and
+    # Diffs before the current position, and from it on in reverse, so that
+    # edits near the current position don't shift the whole list.
+    done = []
+    todo = diffs[::-1]
+    while todo:
+        diff = todo.pop()
+        if diff.op == Ops.EQUAL:  # Equality found.
+            if (len(diff.text) < DIFF_EDIT_COST and
                     (post_ins or post_del)):
                 # Candidate found.
-                equalities.append(pointer)
+                equalities.append(len(done))
                 pre_ins = post_ins
                 pre_del = post_del
-                lastequality = diffs[pointer].text
+                lastequality = diff.text
             else:
                 # Not a candidate, and can never become one.
                 equalities = []
@@ -691,7 +1189,7 @@ def cleanup_efficiency(diffs):
 
             post_ins = post_del = False
         else:  # An insertion or deletion.
-            if diffs[pointer].op == Ops.DELETE:
+            if diff.op == Ops.DELETE:
                 post_del = True
             else:
                 post_ins = True
@@ -706,26 +1204,30 @@ def cleanup_efficiency(diffs):
             if lastequality and ((pre_ins and pre_del and post_ins and post_del) or
                                                      ((len(lastequality) < DIFF_EDIT_COST / 2) and
                                                         (pre_ins + pre_del + post_ins + post_del) == 3)):
-                # Duplicate record.
-                diffs.insert(equalities[-1], Diff(Ops.DELETE, lastequality))
-                # Change second copy to insert.
-                diffs[equalities[-1] + 1] = Diff(Ops.INSERT, diffs[equalities[-1] + 1].text)
-                equalities.pop()  # Throw away the equality we just deleted.
+                # Duplicate record, and change second copy to insert.
+                index = equalities.pop()  # Throw away the equality we just deleted.
+                done[index] = Diff(Ops.INSERT, done[index].text)
+                done.insert(index, Diff(Ops.DELETE, lastequality))
                 lastequality = None
                 if pre_ins and pre_del:
                     # No changes made which could affect previous entry, keep going.
                     post_ins = post_del = True
                     equalities = []
+                    # The insertion shifted this diff, so it's checked again.
+                    todo.append(diff)
                 else:
                     if len(equalities):
                         equalities.pop()  # Throw away the previous equality.
-                    if len(equalities):
-                        pointer = equalities[-1]
-                    else:
-                        pointer = -1
+                    # Resume right after the last remaining equality.
+                    resume = equalities[-1] + 1 if equalities else 0
+                    todo.append(diff)
+                    todo.extend(reversed(done[resume:]))
+                    del done[resume:]
                     post_ins = post_del = False
                 changes = True
-        pointer += 1
+                continue
+        done.append(diff)
+    diffs[:] = done
 
     if changes:
         cleanup_merge(diffs)
@@ -737,107 +1239,286 @@ def cleanup_merge(diffs):
     Args:
         diffs: List of diff tuples.
     """
-    diffs.append(Diff(Ops.EQUAL, ''))  # Add a dummy entry at the end.
-    pointer = 0
-    count_delete = 0
-    count_insert = 0
-    text_delete = ''
-    text_insert = ''
-    while pointer < len(diffs):
-        if diffs[pointer].op == Ops.INSERT:
-            count_insert += 1
-            text_insert += diffs[pointer].text
-            pointer += 1
-        elif diffs[pointer].op == Ops.DELETE:
-            count_delete += 1
-            text_delete += diffs[pointer].text
-            pointer += 1
-        elif diffs[pointer].op == Ops.EQUAL:
+    changes = True
+    while changes:
+        merged = merge_edits(diffs)
+        changes = shift_edits(merged)
+        diffs[:] = merged
+
+def merge_edits(diffs):
+    """First pass of `cleanup_merge`: merge runs of edits between equalities,
+    factoring out their common prefix and suffix, and merge adjacent
+    equalities.
+
+    Args:
+        diffs: List of diff tuples.
+
+    Returns:
+        New list of diff tuples.
+    """
+    out = []
+    # Equality at the end of the output, still to be added, and the texts it
+    # consists of if other equalities were merged into it.
+    equality = None
+    parts = None
+    inserts = []
+    deletes = []
+    single = None
+    # Drop empty entries, which would only confuse the shifting of edits, and
+    # add a dummy entry at the end.
+    for diff in itertools.chain((diff for diff in diffs if diff.text), [Diff(Ops.EQUAL, '')]):
+        if diff.op == Ops.INSERT:
+            inserts.append(diff.text)
+            single = diff
+        elif diff.op == Ops.DELETE:
+            deletes.append(diff.text)
+            single = diff
+        elif diff.op == Ops.EQUAL:
             # Upon reaching an equality, check for prior redundancies.
-            if count_delete + count_insert > 1:
-                if count_delete != 0 and count_insert != 0:
+            if len(deletes) + len(inserts) > 1:
+                text_insert = ''.join(inserts)
+                text_delete = ''.join(deletes)
+                if deletes and inserts:
                     # Factor out any common prefixies.
                     common_length = common_prefix_length(text_insert, text_delete)
                     if common_length != 0:
-                        x = pointer - count_delete - count_insert - 1
-                        if x >= 0 and diffs[x].op == Ops.EQUAL:
-                            diffs[x] = diffs[x]._replace(text=(diffs[x].text + text_insert[:common_length]))
+                        if equality is None:
+                            equality = Diff(Ops.EQUAL, text_insert[:common_length])
+                        elif parts is None:
+                            parts = [equality.text, text_insert[:common_length]]
                         else:
-                            diffs.insert(0, Diff(Ops.EQUAL, text_insert[:common_length]))
-                            pointer += 1
+                            parts.append(text_insert[:common_length])
                         text_insert = text_insert[common_length:]
                         text_delete = text_delete[common_length:]
                     # Factor out any common suffixies.
                     common_length = common_suffix_length(text_insert, text_delete)
                     if common_length != 0:
-                        diffs[pointer] = diffs[pointer]._replace(text=(
-                            text_insert[-common_length:] + diffs[pointer].text
-                        ))
+                        diff = diff._replace(text=(text_insert[-common_length:] + diff.text))
                         text_insert = text_insert[:-common_length]
                         text_delete = text_delete[:-common_length]
-                # Delete the offending records and add the merged ones.
-                if count_delete == 0:
-                    diffs[pointer - count_insert : pointer] = [Diff(Ops.INSERT, text_insert)]
-                elif count_insert == 0:
-                    diffs[pointer - count_delete : pointer] = [Diff(Ops.DELETE, text_delete)]
+                # Replace the offending records with the merged ones.
+                if text_delete or text_insert:
+                    if equality is not None:
+                        out.append(equality if parts is None else Diff(Ops.EQUAL, ''.join(parts)))
+                    if text_delete:
+                        out.append(Diff(Ops.DELETE, text_delete))
+                    if text_insert:
+                        out.append(Diff(Ops.INSERT, text_insert))
+                    (equality, parts) = (diff, None)
+                # Nothing is left of the edits, so the equalities around them
+                # merge.
+                elif parts is None:
+                    parts = [equality.text, diff.text]
                 else:
-                    diffs[pointer - count_delete - count_insert : pointer] = [
-                            Diff(Ops.DELETE, text_delete),
-                            Diff(Ops.INSERT, text_insert)]
-                pointer = pointer - count_delete - count_insert + 1
-                if count_delete != 0:
-                    pointer += 1
-                if count_insert != 0:
-                    pointer += 1
-            elif pointer != 0 and diffs[pointer - 1].op == Ops.EQUAL:
+                    parts.append(diff.text)
+            elif inserts or deletes:
+                if equality is not None:
+                    out.append(equality if parts is None else Diff(Ops.EQUAL, ''.join(parts)))
+                out.append(single)
+                (equality, parts) = (diff, None)
+            elif equality is None:
+                equality = diff
+            elif parts is None:
                 # Merge this equality with the previous one.
-                diffs[pointer - 1] = diffs[pointer - 1]._replace(text=(
-                    diffs[pointer - 1].text + diffs[pointer].text
-                ))
-                del diffs[pointer]
+                parts = [equality.text, diff.text]
             else:
-                pointer += 1
+                parts.append(diff.text)
 
-            count_insert = 0
-            count_delete = 0
-            text_delete = ''
-            text_insert = ''
+            inserts = []
+            deletes = []
+
+    # Drop the dummy entry at the end, unless it got some text.
+    if parts is not None:
+        equality = Diff(Ops.EQUAL, ''.join(parts))
+    if equality.text != '':
+        out.append(equality)
+    return out
 
-    if diffs[-1].text == '':
-        diffs.pop()  # Remove the dummy entry at the end.
+def shift_edits(diffs):
+    """Second pass of `cleanup_merge`: look for single edits surrounded on
+    both sides by equalities which can be shifted sideways to eliminate an
+    equality.
+    e.g: A<ins>BA</ins>C -> <ins>AB</ins>AC
+
+    Args:
+        diffs: List of diff tuples, modified in place.
 
-    # Second pass: look for single edits surrounded on both sides by equalities
-    # which can be shifted sideways to eliminate an equality.
-    # e.g: A<ins>BA</ins>C -> <ins>AB</ins>AC
+    Returns:
+        Whether any edits were shifted.
+    """
     changes = False
-    pointer = 1
     # Intentionally ignore the first and last element (don't need checking).
-    while pointer < len(diffs) - 1:
-        if (diffs[pointer - 1].op == Ops.EQUAL and
-                diffs[pointer + 1].op == Ops.EQUAL):
+    done = diffs[:1]
+    todo = diffs[:0:-1]
+    while len(todo) > 1:
+        (before, diff, after) = (done[-1], todo[-1], todo[-2])
+        if before.op == Ops.EQUAL and after.op == Ops.EQUAL:
             # This is a single edit surrounded by equalities.
-            if diffs[pointer].text.endswith(diffs[pointer - 1].text):
+            if diff.text.endswith(before.text):
                 # Shift the edit over the previous equality.
-                diffs[pointer] = diffs[pointer]._replace(text=(
-                    diffs[pointer - 1].text + diffs[pointer].text[:-len(diffs[pointer - 1].text)]
-                ))
-                diffs[pointer + 1] = diffs[pointer + 1]._replace(text=(
-                    diffs[pointer - 1].text + diffs[pointer + 1].text
-                ))
-                del diffs[pointer - 1]
+                done[-1] = diff._replace(text=(before.text + diff.text[:-len(before.text)]))
+                done.append(after._replace(text=(before.text + after.text)))
+                del todo[-2:]
                 changes = True
-            elif diffs[pointer].text.startswith(diffs[pointer + 1].text):
+                continue
+            elif diff.text.startswith(after.text):
                 # Shift the edit over the next equality.
-                diffs[pointer - 1] = diffs[pointer - 1]._replace(text=(
-                    diffs[pointer - 1].text + diffs[pointer + 1].text
-                ))
-                diffs[pointer] = diffs[pointer]._replace(text=(
-                    diffs[pointer].text[len(diffs[pointer + 1].text):] + diffs[pointer + 1].text
-                ))
-                del diffs[pointer + 1]
+                done[-1] = before._replace(text=(before.text + after.text))
+                done.append(diff._replace(text=(diff.text[len(after.text):] + after.text)))
+                del todo[-2:]
                 changes = True
-        pointer += 1
+                continue
+        done.append(todo.pop())
+    done.extend(reversed(todo))
+    diffs[:] = done
+    return changes
+
+class Spans(object):
+    """Compact alternative to a list of `Diff`: ops are stored as small ints
+    alongside (start, end) offsets into the original texts, rather than as
+    copies of the text.  EQUAL and DELETE spans index the old text, INSERT
+    spans index the new text.  Adjacent spans of the same op are merged.
+    """
+    __slots__ = ('ops', 'starts', 'ends')
 
-    # If shifts were made, the diff needs reordering and another shift sweep.
-    if changes:
-        cleanup_merge(diffs)
+    def __init__(self):
+        self.ops = array('b')
+        self.starts = array('q')
+        self.ends = array('q')
+
+    def append(self, op, start, end):
+        if start >= end:
+            return
+        if self.ops and self.ops[-1] == op and self.ends[-1] == start:
+            self.ends[-1] = end
+            return
+        self.ops.append(op)
+        self.starts.append(start)
+        self.ends.append(end)
+
+    def __len__(self):
+        return len(self.ops)
+
+    def __iter__(self):
+        return zip(self.ops, self.starts, self.ends)
+
+    def diffs(self, text1, text2):
+        """Materialize as a list of `Diff`.
+
+        Args:
+            text1: Old string the spans were computed from.
+            text2: New string the spans were computed from.
+
+        Returns:
+            List of changes.
+        """
+        return [
+            Diff(OP_NAMES[op], (text2 if op == SpanOps.INSERT else text1)[start:end])
+            for (op, start, end) in self
+        ]
+
+def diff_spans(diffs):
+    """Convert a list of `Diff` into `Spans` over the texts it was computed
+    from.
+
+    Args:
+        diffs: List of changes.
+
+    Returns:
+        Spans.
+    """
+    spans = Spans()
+    (pos1, pos2) = (0, 0)
+    for (op, text) in diffs:
+        size = len(text)
+        if op == Ops.INSERT:
+            spans.append(SpanOps.INSERT, pos2, pos2 + size)
+            pos2 += size
+        else:
+            spans.append(SPAN_OPS[op], pos1, pos1 + size)
+            pos1 += size
+            if op == Ops.EQUAL:
+                pos2 += size
+    return spans
+
+def edit_hunks(spans, max_gap=0):
+    """Coalesce spans into replacements: each run of edits between
+    equalities becomes one, and so do runs separated only by equalities of up
+    to `max_gap` characters, which are then rewritten with the same text.
+
+    Args:
+        spans: Spans of old and new texts.
+        max_gap: Length of the longest equality to rewrite.
+
+    Returns:
+        List of (start1, end1, start2, end2) in increasing order, meaning
+        that text1[start1:end1] is replaced by text2[start2:end2].
+    """
+    hunks = []
+    hunk = None
+    (pos1, pos2) = (0, 0)
+    for (op, start, end) in spans:
+        if op == SpanOps.EQUAL:
+            pos1 += end - start
+            pos2 += end - start
+            continue
+        if hunk is None or pos1 - hunk[1] > max_gap:
+            if hunk is not None:
+                hunks.append(tuple(hunk))
+            hunk = [pos1, pos1, pos2, pos2]
+        if op == SpanOps.DELETE:
+            pos1 += end - start
+        else:
+            pos2 += end - start
+        hunk[1] = pos1
+        hunk[3] = pos2
+    if hunk is not None:
+        hunks.append(tuple(hunk))
+    return hunks
+
+# Registered diff engines, by name.  See `register_engine`.
+ENGINES = {}
+
+def register_engine(name, fun):
+    """Make a diff engine available by name, for `engine_spans` and the
+    "diff_engine" setting.
+
+    Args:
+        name: Engine name.
+        fun: Function taking (text1, text2, deadline, table) and returning
+            `Spans` which, applied to text1, produce text2.  `table` is an
+            optional LineTable that line-based engines may reuse.  It must not
+            raise TooManyDiffsException.
+    """
+    ENGINES[name] = fun
+
+def engine_spans(name, text1, text2, deadline=None, table=None):
+    """Find the differences between two texts using a registered engine.
+
+    Args:
+        name: Engine name.
+        text1: Old string to be diffed.
+        text2: New string to be diffed.
+        deadline: Optional deadline, see `myers_diffs`.
+        table: Optional LineTable to reuse, see `lines_to_tokens`.
+
+    Returns:
+        Spans.
+    """
+    if name not in ENGINES:
+        raise KeyError(name)
+    return ENGINES[name](text1, text2, deadline, table)
+
+def engine_diffs(name, text1, text2, deadline=None, table=None):
+    """Like `engine_spans`, but returns a list of changes."""
+    return engine_spans(name, text1, text2, deadline, table).diffs(text1, text2)
+
+def myers_engine(text1, text2, deadline, table):
+    diffs = myers_diffs(text1, text2, True, NO_DEADLINE if deadline is None else deadline, table)
+    cleanup_efficiency(diffs)
+    return diff_spans(diffs)
+
+register_engine('myers', myers_engine)
+register_engine('myers_lines', lambda text1, text2, deadline, table: line_spans(text1, text2, deadline, no_anchors, table))
+register_engine('patience', lambda text1, text2, deadline, table: line_spans(text1, text2, deadline, patience_anchors, table))
+register_engine('histogram', lambda text1, text2, deadline, table: line_spans(text1, text2, deadline, histogram_anchors, table))
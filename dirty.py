@@ -0,0 +1,90 @@
+"""
+Tracking of the lines changed in a buffer since it was last formatted, for
+formatters that can format only some lines of their input, such as
+`clang-format --lines`. Exposed to commands as "$dirty_*" variables; see the
+"format_on_save_range" setting.
+"""
+
+import re
+
+# Matches "$dirty_..." and "${dirty_...}".
+VARIABLE = re.compile(r'\$\{?dirty_')
+
+class DirtyLines(object):
+    """Rows changed since the buffer was last formatted, as sorted, disjoint,
+    half-open ranges in the current coordinates of the buffer. Created
+    anew after every format, remembering the change count of the buffer at
+    that point.
+    """
+    __slots__ = ('change_count', 'ranges')
+
+    def __init__(self, change_count):
+        self.change_count = change_count
+        self.ranges = []
+
+    def change(self, row_a, row_b, text):
+        """Record that the text from row `row_a` to row `row_b`, inclusive,
+        was replaced with `text`.  Rows after the change shift by the
+        difference in line count.
+        """
+        added = text.count('\n')
+        shift = added - (row_b - row_a)
+        (start, end) = (row_a, row_a + added + 1)
+        (before, after) = ([], [])
+        for (lo, hi) in self.ranges:
+            if hi < row_a:
+                before.append((lo, hi))
+            elif lo > row_b + 1:
+                after.append((lo + shift, hi + shift))
+            else:
+                # Overlaps or touches the change.
+                start = min(start, lo)
+                end = max(end, hi + shift)
+        self.ranges = before + [(start, end)] + after
+
+    def bounds(self):
+        """Returns the half-open range of rows spanning all changes, or None
+        when nothing changed."""
+        if not self.ranges:
+            return None
+        return (self.ranges[0][0], self.ranges[-1][1])
+
+def uses_variables(arg):
+    return VARIABLE.search(arg) is not None
+
+def range_variables(text, rows=None):
+    """Substitution variables describing a range of lines of `text`.
+
+    Args:
+        text: Input of the formatter.
+        rows: Optional half-open range of rows, as from `DirtyLines.bounds`.
+            Clipped to the text. When None, the range is the whole text.
+
+    Returns:
+        Dict of variables: "dirty_start" and "dirty_end" are the first and
+        last line, counting from 1; "dirty_lines" is both as "start:end";
+        "dirty_start_offset" and "dirty_end_offset" are the character
+        offsets of the range, the end being exclusive.
+    """
+    line_count = text.count('\n') + 1
+    (start, end) = rows or (0, line_count)
+    start = min(max(start, 0), line_count - 1)
+    end = min(max(end, start + 1), line_count)
+    start_offset = row_offset(text, start)
+    end_offset = row_offset(text, end, start_offset, start)
+    return {
+        'dirty_start': str(start + 1),
+        'dirty_end': str(end),
+        'dirty_lines': '{}:{}'.format(start + 1, end),
+        'dirty_start_offset': str(start_offset),
+        'dirty_end_offset': str(end_offset),
+    }
+
+# Offset at which `row` starts, or the length of the text for the row after
+# the last. Counts from `offset`, which must be the start of `from_row`.
+def row_offset(text, row, offset=0, from_row=0):
+    for _ in range(row - from_row):
+        offset = text.find('\n', offset) + 1
+        if not offset:
+            return len(text)
+    return offset
@@ -0,0 +1,98 @@
+"""
+Process launching for formatters.
+
+Executables named without a directory are looked up in PATH once per (name,
+PATH) instead of on every launch. Names with a directory, such as
+"node_modules/.bin/prettier", are passed through as-is, so that relative ones
+resolve against the formatter's CWD, as with plain `Popen`.
+
+On POSIX, processes are started in a new session, so that `kill` can kill the
+processes they start too, such as the formatter behind `sh -c`, `npx` or
+`go fmt`. Otherwise these keep the output pipes open after the timeout or
+cancellation, and reading the output waits for them to exit.
+"""
+
+import os
+import shutil
+import signal
+import subprocess as sub
+import threading
+
+IS_WINDOWS = os.name == 'nt'
+
+EXE_CACHE = {}
+EXE_CACHE_LOCK = threading.Lock()
+
+def popen(args, cwd=None, env=None, startupinfo=None):
+    exe = resolve_exe(args[0], env)
+    try:
+        return popen_exe(args, exe, cwd, env, startupinfo)
+    except FileNotFoundError:
+        # The executable may have been moved or uninstalled since it was
+        # resolved. Resolve again, and if that fails, let `Popen` produce its
+        # usual error.
+        forget_exe(args[0], env)
+        retry_exe = resolve_exe(args[0], env)
+        if retry_exe == exe:
+            raise
+        return popen_exe(args, retry_exe, cwd, env, startupinfo)
+
+def popen_exe(args, exe, cwd, env, startupinfo):
+    return sub.Popen(
+        args=args,
+        executable=exe,
+        stdin=sub.PIPE,
+        stdout=sub.PIPE,
+        stderr=sub.PIPE,
+        startupinfo=startupinfo,
+        universal_newlines=False,
+        start_new_session=not IS_WINDOWS,
+        cwd=cwd,
+        env=env,
+    )
+
+# Kills the process and, on POSIX, every process in its session that hasn't
+# left its process group. Does nothing once the process has been waited for,
+# since its ID may have been reused.
+def kill(proc):
+    if proc.returncode is not None:
+        return
+    try:
+        if IS_WINDOWS:
+            proc.kill()
+        else:
+            os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+# Returns the absolute path of the executable, or the name as-is when it can't
+# be found or contains a directory.
+def resolve_exe(name, env):
+    if has_dir(name):
+        return name
+
+    path = env_path(env)
+    key = (name, path)
+
+    exe = EXE_CACHE.get(key)
+    if exe is not None:
+        return exe
+
+    exe = shutil.which(name, path=path)
+    if exe is None:
+        return name
+
+    exe = os.path.abspath(exe)
+    with EXE_CACHE_LOCK:
+        EXE_CACHE[key] = exe
+    return exe
+
+def forget_exe(name, env):
+    with EXE_CACHE_LOCK:
+        EXE_CACHE.pop((name, env_path(env)), None)
+
+def has_dir(name):
+    return os.sep in name or (os.altsep is not None and os.altsep in name)
+
+def env_path(env):
+    return (os.environ if env is None else env).get('PATH', os.defpath)
@@ -0,0 +1,165 @@
+"""
+Formatting files on disk rather than in views, for "Fmt: Format Project":
+finding the files, writing results back, and counting outcomes.
+"""
+
+import codecs
+import collections
+import fnmatch
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+CHANGED = 'changed'
+UNCHANGED = 'unchanged'
+SKIPPED = 'skipped'
+FAILED = 'failed'
+
+OUTCOMES = (CHANGED, UNCHANGED, SKIPPED, FAILED)
+
+# Bytes of the first line read to detect the syntax of a file, as Sublime's
+# "first_line_match" does, before reading the rest.
+FIRST_LINE_LIMIT = 4096
+
+def walk(folders, folder_excludes=(), file_excludes=()):
+    """Yields the paths of the files under `folders`, in order, skipping
+    directories and files whose names match any of the respective glob
+    patterns, as in Sublime's "folder_exclude_patterns" and
+    "file_exclude_patterns". Nested folders are walked once.
+    """
+    seen = set()
+    for folder in folders:
+        for (root, dirs, files) in os.walk(folder):
+            if root in seen:
+                dirs[:] = []
+                continue
+            seen.add(root)
+            dirs[:] = sorted(name for name in dirs if not matches(name, folder_excludes))
+            for name in sorted(files):
+                if not matches(name, file_excludes):
+                    yield os.path.join(root, name)
+
+def matches(name, patterns):
+    return any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+
+def write_atomic(path, data):
+    """Replaces the content of the file at `path` with `data`, which are
+    bytes, such that readers see either the old or the new content. Keeps
+    the file's mode. Writes through symlinks.
+    """
+    path = os.path.realpath(path)
+    (fd, temp) = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.' + os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        shutil.copymode(path, temp)
+        os.replace(temp, path)
+    except BaseException:
+        try:
+            os.remove(temp)
+        except OSError:
+            pass
+        raise
+
+def fmt_file(path, fmt_for, check=False):
+    """Formats the file at `path`, returning one of the outcomes.
+    `fmt_for(first_line)` is called with the first line of the file, before
+    the rest is read, and returns a function from the source to the formatted
+    source, or None to skip the file. Files that aren't UTF-8 are skipped, as
+    are files changed on disk while being formatted. With `check`, changed
+    files aren't written.
+    """
+    version = file_version(path)
+    with open(path, 'rb') as file:
+        head = file.readline(FIRST_LINE_LIMIT)
+        try:
+            # Incremental, in case the limit splits a character.
+            first_line = codecs.getincrementaldecoder('utf-8')().decode(head)
+        except UnicodeDecodeError:
+            return SKIPPED
+        fmt = fmt_for(first_line.rstrip('\r\n'))
+        if fmt is None:
+            return SKIPPED
+        try:
+            source = (head + file.read()).decode('utf-8')
+        except UnicodeDecodeError:
+            return SKIPPED
+
+    fmted = fmt(source)
+    if fmted == source:
+        return UNCHANGED
+    if check:
+        return CHANGED
+    if file_version(path) != version:
+        return SKIPPED
+    write_atomic(path, fmted.encode('utf-8'))
+    return CHANGED
+
+# Identifies a version of a file on disk, to detect changes between reading
+# and writing it.
+def file_version(path):
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+class Progress(object):
+    """Outcomes of formatting files, recorded from any thread."""
+    def __init__(self, root=None, interval=0.25):
+        self.root = root
+        self.interval = interval
+        self.counts = collections.Counter()
+        self.changed = []
+        self.errors = []
+        self.start = time.perf_counter()
+        self.rendered = self.start
+        self.lock = threading.Lock()
+
+    def add(self, path, outcome, err=None):
+        """Returns True when it's time to show progress again."""
+        now = time.perf_counter()
+        with self.lock:
+            self.counts[outcome] += 1
+            if outcome == CHANGED:
+                self.changed.append(path)
+            elif outcome == FAILED:
+                self.errors.append((path, err))
+            if now - self.rendered < self.interval:
+                return False
+            self.rendered = now
+            return True
+
+    def render(self, done=False):
+        with self.lock:
+            counts = dict(self.counts)
+            changed = sorted(self.changed)
+            errors = sorted(self.errors, key=lambda pair: pair[0])
+
+        total = sum(counts.values())
+        summary = '{} {} files in {:.1f}s: {}'.format(
+            'formatted' if done else 'formatting...',
+            total,
+            time.perf_counter() - self.start,
+            ', '.join('{} {}'.format(counts.get(outcome, 0), outcome) for outcome in OUTCOMES),
+        )
+        if not done:
+            return summary
+
+        lines = [summary]
+        if changed:
+            lines.append('')
+            lines.append('changed:')
+            lines.extend('    ' + self.relative(path) for path in changed)
+        for (path, err) in errors:
+            lines.append('')
+            lines.append('{}:'.format(self.relative(path)))
+            lines.append(str(err))
+        return '\n'.join(lines)
+
+    def relative(self, path):
+        if self.root is None:
+            return path
+        try:
+            return os.path.relpath(path, self.root)
+        except ValueError:
+            return path
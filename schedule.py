@@ -0,0 +1,121 @@
+"""
+Per-view scheduling of background formats.
+
+Every view runs at most one background format at a time, and keeps at most one
+more waiting. A request for a newer snapshot of the buffer replaces the waiting
+one, whose result would be stale, and kills the formatter of the running one,
+instead of letting it run to completion, possibly for the whole "timeout".
+A request for the same snapshot as the running one waits for it instead, and
+reuses its result via `Job.once`, so the formatter isn't run again.
+"""
+
+import threading
+import traceback
+from . import launch
+from .daemon import spawn_thread
+
+class Cancelled(Exception):
+    pass
+
+class Job(object):
+    """A background format of one snapshot of a buffer. `version` identifies
+    the snapshot, such as its change count. The process currently running
+    for the job, if any, is attached with `attach` and killed by `cancel`,
+    along with the processes it started, which may hold its pipes open.
+    """
+    def __init__(self, version, fun):
+        self.version = version
+        self.fun = fun
+        self.cancelled = False
+        self.proc = None
+        self.lock = threading.Lock()
+        # The job for the same snapshot that ran before this one, if any.
+        self.previous = None
+        self.result = None
+        self.has_result = False
+        self.reused = False
+
+    def once(self, fun):
+        """Returns `fun()`, or the result of the previous job for the same
+        snapshot, if it completed. Errors aren't kept, so a failed call is
+        repeated by the next job.
+        """
+        previous = self.previous
+        self.previous = None
+        if previous is not None and previous.has_result:
+            self.result = previous.result
+            self.reused = True
+        else:
+            self.result = fun()
+        self.has_result = True
+        return self.result
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            proc = self.proc
+        if proc is not None:
+            launch.kill(proc)
+
+    # Raises `Cancelled` if the job has been cancelled.
+    def check(self):
+        if self.cancelled:
+            raise Cancelled()
+
+    def attach(self, proc):
+        with self.lock:
+            self.proc = proc
+            cancelled = self.cancelled
+        if cancelled and proc is not None:
+            launch.kill(proc)
+
+    def detach(self):
+        self.attach(None)
+
+class Scheduler(object):
+    def __init__(self):
+        self.running = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def submit(self, key, version, fun):
+        """Run `fun(job)` on a background thread once nothing else runs for
+        `key`. `fun` is expected to handle its own errors, including
+        `Cancelled`, which its formatter raises when superseded.
+        """
+        job = Job(version, fun)
+        with self.lock:
+            running = self.running.get(key)
+            if running is None:
+                self.running[key] = job
+            else:
+                if running.version == version:
+                    job.previous = running
+                self.pending[key] = job
+        if running is None:
+            spawn_thread(self.run, key, job)
+        elif running.version != version:
+            running.cancel()
+        return job
+
+    def cancel(self, key):
+        """Drop the waiting job for `key` and cancel the running one."""
+        with self.lock:
+            self.pending.pop(key, None)
+            running = self.running.get(key)
+        if running is not None:
+            running.cancel()
+
+    def run(self, key, job):
+        while job is not None:
+            # Unexpected errors must not stop the jobs waiting behind.
+            try:
+                job.fun(job)
+            except Exception:
+                traceback.print_exc()
+            with self.lock:
+                job = self.pending.pop(key, None)
+                if job is None:
+                    del self.running[key]
+                else:
+                    self.running[key] = job
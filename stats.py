@@ -0,0 +1,117 @@
+"""
+Timing of formatting operations, broken down by phase and grouped by rule.
+
+Each operation records into a `Timing`, which is then added to `Stats`. Stats
+keep a rolling window of recent samples per rule and phase, and render them as
+a plain-text table with p50/p95/max.
+"""
+
+import collections
+import contextlib
+import threading
+import time
+
+WINDOW_SIZE = 512
+
+# Order in which phases are rendered. Unknown phases are rendered last.
+PHASES = [
+    'settings',
+    'cache',
+    'spawn',
+    'encode',
+    'formatter',
+    'decode',
+    'diff',
+    'cleanup',
+    'apply',
+    'total',
+]
+
+class Timing(object):
+    def __init__(self):
+        self.phases = collections.OrderedDict()
+        self.events = collections.Counter()
+        self.start = time.perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, secs):
+        self.phases[name] = self.phases.get(name, 0) + secs
+
+    def event(self, name):
+        self.events[name] += 1
+
+    def finish(self):
+        self.phases['total'] = time.perf_counter() - self.start
+
+class Stats(object):
+    def __init__(self, window_size=WINDOW_SIZE):
+        self.window_size = window_size
+        self.samples = {}
+        self.events = {}
+        self.lock = threading.Lock()
+
+    def record(self, rule, timing):
+        if 'total' not in timing.phases:
+            timing.finish()
+
+        with self.lock:
+            samples = self.samples.setdefault(rule, {})
+            for (phase, secs) in timing.phases.items():
+                window = samples.get(phase)
+                if window is None:
+                    window = samples[phase] = collections.deque(maxlen=self.window_size)
+                window.append(secs)
+            self.events.setdefault(rule, collections.Counter()).update(timing.events)
+
+    def clear(self):
+        with self.lock:
+            self.samples.clear()
+            self.events.clear()
+
+    def render(self):
+        with self.lock:
+            samples = {rule: {phase: list(window) for (phase, window) in phases.items()} for (rule, phases) in self.samples.items()}
+            events = {rule: dict(counter) for (rule, counter) in self.events.items()}
+
+        if not samples:
+            return 'no formatting operations recorded yet'
+
+        lines = []
+        for rule in sorted(samples):
+            lines.append('{}:'.format(rule))
+            lines.append('  {:<12}{:>7}{:>11}{:>11}{:>11}'.format('phase', 'n', 'p50', 'p95', 'max'))
+            for phase in sorted(samples[rule], key=phase_order):
+                vals = sorted(samples[rule][phase])
+                lines.append('  {:<12}{:>7}{:>11}{:>11}{:>11}'.format(
+                    phase,
+                    len(vals),
+                    fmt_ms(percentile(vals, 0.5)),
+                    fmt_ms(percentile(vals, 0.95)),
+                    fmt_ms(vals[-1]),
+                ))
+            for (name, count) in sorted(events.get(rule, {}).items()):
+                lines.append('  {}: {}'.format(name, count))
+            lines.append('')
+
+        return '\n'.join(lines)
+
+def phase_order(phase):
+    try:
+        return (PHASES.index(phase), phase)
+    except ValueError:
+        return (len(PHASES), phase)
+
+# Nearest-rank percentile of a sorted non-empty list.
+def percentile(vals, fraction):
+    index = max(0, min(len(vals) - 1, int(round(fraction * len(vals))) - 1))
+    return vals[index]
+
+def fmt_ms(secs):
+    return '{:.2f}ms'.format(secs * 1000)
@@ -0,0 +1,75 @@
+"""
+Streaming alternative to `Popen.communicate`, for very large inputs.
+
+`Popen.communicate` holds the entire encoded input, the entire raw output and
+then the decoded output in memory at once. Here, the input is encoded in
+chunks as it's written, and the output is decoded in chunks as it's read, so
+neither is held in memory encoded in full.
+"""
+
+import codecs
+import subprocess as sub
+import threading
+from . import launch
+from .daemon import spawn_thread
+
+CHUNK_SIZE = 1 << 16
+
+# Returns `(stdout, stderr)` decoded as strings.
+def communicate(proc, input, encoding, timeout):
+    stderr = []
+    timed_out = []
+
+    def kill():
+        timed_out.append(True)
+        launch.kill(proc)
+
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, kill)
+        timer.daemon = True
+        timer.start()
+
+    writer = spawn_thread(write_chunks, proc.stdin, input, encoding)
+    reader = spawn_thread(read_chunks, proc.stderr, stderr.append)
+
+    try:
+        stdout = []
+        decoder = codecs.getincrementaldecoder(encoding)()
+        read_chunks(proc.stdout, lambda chunk: stdout.append(decoder.decode(chunk)))
+        stdout.append(decoder.decode(b'', final=True))
+
+        writer.join()
+        reader.join()
+        proc.wait()
+    finally:
+        if timer is not None:
+            timer.cancel()
+
+    if timed_out:
+        raise sub.TimeoutExpired(proc.args, timeout)
+
+    return (''.join(stdout), b''.join(stderr).decode(encoding))
+
+def write_chunks(pipe, input, encoding):
+    encoder = codecs.getincrementalencoder(encoding)()
+    try:
+        for i in range(0, len(input), CHUNK_SIZE):
+            pipe.write(encoder.encode(input[i:i+CHUNK_SIZE]))
+        pipe.write(encoder.encode('', final=True))
+    # The process exited without reading everything; its exit code and output
+    # explain why.
+    except (BrokenPipeError, OSError, ValueError):
+        pass
+    finally:
+        try:
+            pipe.close()
+        except OSError:
+            pass
+
+def read_chunks(pipe, fun):
+    while True:
+        chunk = pipe.read1(CHUNK_SIZE) if hasattr(pipe, 'read1') else pipe.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        fun(chunk)